@@ -1,25 +1,31 @@
 from __future__ import annotations
 
 import os
-import json
-import random
+import hashlib
+import functools
+import time
+import asyncio
 import sqlite3
 import pathlib
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, date
 from typing import Optional
 
+import aiosqlite
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi import FastAPI, Request, HTTPException, Header, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 
 
 # ─────────────────────────────────────────────
 # Env & app
 load_dotenv()
 
-app = FastAPI(title="Dice Game API")
+app = FastAPI(title="Dice Game API", default_response_class=ORJSONResponse)
 
 # CORS — for production, restrict this to your front-end origin
 FRONTEND_ORIGINS = os.getenv("FRONTEND_ORIGINS", "*")
@@ -50,14 +56,72 @@ DB_PATH = pathlib.Path(
 
 # ─────────────────────────────────────────────
 # DB setup
+# Applied to every connection we open: WAL + NORMAL sync (one fsync per checkpoint, not per commit),
+# in-memory temp tables and a larger page cache / mmap so leaderboard sorts stay cache-resident.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA cache_size=-20000;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA foreign_keys=ON;",
+    "PRAGMA mmap_size=268435456;",
+)
+
+
+def _configure(conn: sqlite3.Connection) -> sqlite3.Connection:
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# rolls.created_at is unix epoch seconds, so cooldown math is a plain integer subtraction
+ROLLS_COLUMNS = """
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          telegram_id INTEGER NOT NULL,
+          date_utc TEXT NOT NULL,        -- 'YYYY-MM-DD'
+          roll_index INTEGER NOT NULL,   -- 1..50
+          d1 INTEGER NOT NULL,
+          d2 INTEGER NOT NULL,
+          total INTEGER NOT NULL,
+          created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s','now') AS INTEGER)),
+          UNIQUE(telegram_id, date_utc, roll_index)
+"""
+
+
+def _migrate_rolls_epoch(conn: sqlite3.Connection) -> None:
+    # Older databases stored rolls.created_at as CURRENT_TIMESTAMP text; rebuild the table once with epoch ints.
+    # Its indexes go with the old table and are recreated by init_db's CREATE INDEX IF NOT EXISTS.
+    cols = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(rolls)")}
+    if cols.get("created_at", "INTEGER").upper() == "INTEGER":
+        return
+    conn.executescript(
+        f"""
+        BEGIN;
+        ALTER TABLE rolls RENAME TO rolls_text_ts;
+        CREATE TABLE rolls ({ROLLS_COLUMNS});
+        INSERT INTO rolls(id, telegram_id, date_utc, roll_index, d1, d2, total, created_at)
+          SELECT id, telegram_id, date_utc, roll_index, d1, d2, total,
+                 COALESCE(CAST(strftime('%s', created_at) AS INTEGER), CAST(strftime('%s','now') AS INTEGER))
+          FROM rolls_text_ts;
+        DROP TABLE rolls_text_ts;
+        COMMIT;
+        """
+    )
+
+
+@functools.cache  # schema work runs once per process, however many times init_db() is called
 def init_db() -> None:
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     with sqlite3.connect(DB_PATH, timeout=10) as conn:
-        conn.execute("PRAGMA busy_timeout=5000;")
+        _configure(conn)
+        _migrate_rolls_epoch(conn)
+        fresh_indexes = conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='index' "
+            "AND name IN ('idx_daily_date_score_user', 'idx_rolls_user_day_time')"
+        ).fetchone()[0] < 2
         conn.executescript(
-            """
-        PRAGMA journal_mode=WAL;
-
+            f"""
         CREATE TABLE IF NOT EXISTS users (
           telegram_id INTEGER PRIMARY KEY,
           username TEXT,
@@ -72,17 +136,7 @@ def init_db() -> None:
           updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
 
-        CREATE TABLE IF NOT EXISTS rolls (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          telegram_id INTEGER NOT NULL,
-          date_utc TEXT NOT NULL,        -- 'YYYY-MM-DD'
-          roll_index INTEGER NOT NULL,   -- 1..50
-          d1 INTEGER NOT NULL,
-          d2 INTEGER NOT NULL,
-          total INTEGER NOT NULL,
-          created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-          UNIQUE(telegram_id, date_utc, roll_index)
-        );
+        CREATE TABLE IF NOT EXISTS rolls ({ROLLS_COLUMNS});
 
         CREATE TABLE IF NOT EXISTS daily_totals (
           telegram_id INTEGER NOT NULL,
@@ -101,34 +155,173 @@ def init_db() -> None:
           PRIMARY KEY (telegram_id, week_id)
         );
 
-        CREATE INDEX IF NOT EXISTS idx_rolls_user_day  ON rolls(telegram_id, date_utc);
+        -- (user, day) prefix seek that also covers MAX(created_at), so the /roll state check never touches the table
+        DROP INDEX IF EXISTS idx_rolls_user_day;
+        CREATE INDEX IF NOT EXISTS idx_rolls_user_day_time ON rolls(telegram_id, date_utc, created_at);
         CREATE INDEX IF NOT EXISTS idx_rolls_user_time ON rolls(telegram_id, created_at);
-        CREATE INDEX IF NOT EXISTS idx_daily_date_score ON daily_totals(date_utc, total_score DESC);
-        CREATE INDEX IF NOT EXISTS idx_week_week_score  ON weekly_totals(week_id, total_score DESC);
+        -- leaderboard indexes carry telegram_id so ranking is an index-only scan
+        DROP INDEX IF EXISTS idx_daily_date_score;
+        DROP INDEX IF EXISTS idx_week_week_score;
+        CREATE INDEX IF NOT EXISTS idx_daily_date_score_user ON daily_totals(date_utc, total_score DESC, telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_week_week_score_user  ON weekly_totals(week_id, total_score DESC, telegram_id);
 
         CREATE TABLE IF NOT EXISTS roll_requests (
           id INTEGER PRIMARY KEY AUTOINCREMENT,
           telegram_id INTEGER NOT NULL,
           key TEXT NOT NULL,
-          response_json TEXT NOT NULL,
+          response_json BLOB NOT NULL,  -- orjson bytes
           created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
           UNIQUE(telegram_id, key)
         );
         CREATE INDEX IF NOT EXISTS idx_rollreq_user_time ON roll_requests(telegram_id, created_at);
         """
         )
+        if fresh_indexes:
+            conn.execute("ANALYZE")  # give the planner stats for the new indexes
         conn.commit()
 
 
-def db() -> sqlite3.Connection:
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    return sqlite3.connect(DB_PATH, timeout=10)
-
-
 # call once at import
 init_db()
 
 
+# ─────────────────────────────────────────────
+# Hot SQL, kept as constants so the pooled connections' statement caches reuse the prepared plans
+SQL_COUNT_TODAY = "SELECT COUNT(*) FROM rolls WHERE telegram_id=? AND date_utc=?"
+# The cooldown spans midnight: "last" is the user's latest roll on any day, the count is today's only
+SQL_ROLL_STATE = (
+    "SELECT (SELECT COUNT(*) FROM rolls WHERE telegram_id=?1 AND date_utc=?2), "
+    "CAST(strftime('%s','now') AS INTEGER) - (SELECT MAX(created_at) FROM rolls WHERE telegram_id=?1)"
+)
+SQL_UPSERT_DAILY = """
+    INSERT INTO daily_totals(telegram_id, date_utc, total_score, rolls_count)
+    VALUES(?,?,?,1)
+    ON CONFLICT(telegram_id, date_utc) DO UPDATE SET
+      total_score = total_score + excluded.total_score,
+      rolls_count = rolls_count + 1
+"""
+SQL_UPSERT_WEEKLY = """
+    INSERT INTO weekly_totals(telegram_id, week_id, total_score, days_played)
+    VALUES(?,?,?,0)
+    ON CONFLICT(telegram_id, week_id) DO UPDATE SET
+      total_score = total_score + excluded.total_score
+"""
+# Top `limit` rows (shared by every viewer, so cacheable) and a per-viewer rank probe on the covering index
+SQL_TOP_DAILY = """
+    SELECT telegram_id, total_score FROM daily_totals
+    WHERE date_utc=?
+    ORDER BY total_score DESC, telegram_id ASC
+    LIMIT ?
+"""
+SQL_TOP_WEEKLY = """
+    SELECT telegram_id, total_score FROM weekly_totals
+    WHERE week_id=?
+    ORDER BY total_score DESC, telegram_id ASC
+    LIMIT ?
+"""
+# Rank = 1 + rows ahead in the same (score DESC, id ASC) order the top list uses, so ties agree with it
+SQL_RANK_DAILY = """
+    SELECT 1 + (SELECT COUNT(*) FROM daily_totals
+                WHERE date_utc=?1 AND (total_score > me.total_score
+                                       OR (total_score = me.total_score AND telegram_id < me.telegram_id))),
+           total_score
+    FROM daily_totals me WHERE telegram_id=?2 AND date_utc=?1
+"""
+SQL_RANK_WEEKLY = """
+    SELECT 1 + (SELECT COUNT(*) FROM weekly_totals
+                WHERE week_id=?1 AND (total_score > me.total_score
+                                      OR (total_score = me.total_score AND telegram_id < me.telegram_id))),
+           total_score
+    FROM weekly_totals me WHERE telegram_id=?2 AND week_id=?1
+"""
+SQL_GET_IDEMPO = "SELECT response_json FROM roll_requests WHERE telegram_id=? AND key=?"
+SQL_SAVE_IDEMPO = "INSERT OR IGNORE INTO roll_requests(telegram_id, key, response_json) VALUES (?,?,?) RETURNING id"
+STATEMENT_CACHE_SIZE = 256
+
+
+# ─────────────────────────────────────────────
+# Connection pool: one shared writer (serialised by an asyncio.Lock) + a queue of read-only connections.
+# aiosqlite runs each connection on its own thread, so the endpoints can be async without blocking the
+# event loop, and readers waiting for a connection don't tie up the worker threadpool.
+READ_POOL_SIZE = os.cpu_count() or 4
+
+_write_conn: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+_read_pool: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+
+
+async def _open(readonly: bool = False) -> aiosqlite.Connection:
+    if readonly:
+        conn = await aiosqlite.connect(
+            f"{DB_PATH.as_uri()}?mode=ro", uri=True, timeout=10, cached_statements=STATEMENT_CACHE_SIZE
+        )
+    else:
+        conn = await aiosqlite.connect(DB_PATH, timeout=10, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+async def get_read_conn():
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+@asynccontextmanager
+async def write_conn():
+    # One BEGIN IMMEDIATE ... COMMIT per block (rolled back on error), so a /roll costs a single commit
+    async with _write_lock:
+        await _write_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield _write_conn
+        except BaseException:
+            await _write_conn.rollback()
+            raise
+        await _write_conn.commit()
+
+
+# Keep planner statistics fresh as the tables grow: at boot, every few hours, and on shutdown.
+OPTIMIZE_EVERY_S = 4 * 3600
+
+
+async def optimize_db() -> None:
+    async with _write_lock:
+        await _write_conn.execute("PRAGMA optimize;")
+
+
+@app.on_event("startup")
+async def _open_pool() -> None:
+    global _write_conn
+    _write_conn = await _open()
+    for _ in range(READ_POOL_SIZE):
+        _read_pool.put_nowait(await _open(readonly=True))
+    await optimize_db()
+
+    async def _loop():
+        while True:
+            await asyncio.sleep(OPTIMIZE_EVERY_S)
+            await optimize_db()
+
+    app.state.optimize_task = asyncio.create_task(_loop())
+
+
+@app.on_event("shutdown")
+async def _close_pool() -> None:
+    app.state.optimize_task.cancel()
+    conns = [_write_conn]
+    while not _read_pool.empty():
+        conns.append(_read_pool.get_nowait())
+    for conn in conns:
+        try:
+            await conn.execute("PRAGMA optimize;")  # best effort; read-only connections may not be able to write stats
+        except sqlite3.Error:
+            pass
+        await conn.close()
+
+
 # ─────────────────────────────────────────────
 # Static/web
 if STATIC_DIR.exists():
@@ -143,12 +336,28 @@ def health():
     return {"ok": True, "service": "dice-api"}
 
 
+# leaderboard.html only changes on deploy: read it once at startup and serve it from memory with an ETag
+LEADERBOARD_PAGE = WEB_DIR / "leaderboard.html"
+_page: Optional[tuple] = None  # (body bytes, etag)
+
+
+@app.on_event("startup")
+def _load_leaderboard_page() -> None:
+    global _page
+    if LEADERBOARD_PAGE.exists():
+        body = LEADERBOARD_PAGE.read_bytes()
+        _page = (body, f'"{hashlib.md5(body).hexdigest()}"')
+
+
 @app.get("/leaderboard")
-def serve_leaderboard():
-    path = WEB_DIR / "leaderboard.html"
-    if not path.exists():
-        raise HTTPException(status_code=404, detail=f"leaderboard.html not found at {path}")
-    return FileResponse(path)
+async def serve_leaderboard(if_none_match: Optional[str] = Header(None)):
+    if _page is None:
+        raise HTTPException(status_code=404, detail=f"leaderboard.html not found at {LEADERBOARD_PAGE}")
+    body, etag = _page
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
 
 
 # ─────────────────────────────────────────────
@@ -156,108 +365,131 @@ def serve_leaderboard():
 MAX_DAILY = int(os.getenv("MAX_DAILY", "50"))
 COOLDOWN_S = float(os.getenv("COOLDOWN_S", "4"))
 
+# Limit + cooldown checked inside the insert itself, with the config baked in as literals so SQLite
+# sees constants; RETURNING hands back the new roll_index, or no row when either check refuses the roll.
+SQL_ROLL = f"""
+    INSERT INTO rolls(telegram_id, date_utc, roll_index, d1, d2, total)
+    SELECT ?1, ?2, n + 1, ?3, ?4, ?3 + ?4
+    FROM (SELECT (SELECT COUNT(*) FROM rolls WHERE telegram_id=?1 AND date_utc=?2) AS n,
+                 (SELECT MAX(created_at) FROM rolls WHERE telegram_id=?1) AS last)
+    WHERE n < {MAX_DAILY}
+      AND CAST(strftime('%s','now') AS INTEGER) - COALESCE(last, 0) >= {COOLDOWN_S!r}
+    RETURNING roll_index
+"""
+
 # DEV ONLY fallback user. In production, you should pass a real user id from Telegram WebApp.
 TEST_USER_ID = int(os.getenv("TEST_USER_ID", "12345"))
 
+# Upper bound for ?limit= on the leaderboards; keeps each top-K fetch (and cache entry) O(limit).
+# SQLite treats a negative LIMIT as "no limit", so the lower bound matters too.
+LEADERBOARD_MAX_LIMIT = 100
 
-def today_utc_str() -> str:
-    return datetime.now(timezone.utc).date().isoformat()
 
+# Buffer of dice faces drawn from os.urandom; bytes >= 252 are rejected so faces stay unbiased.
+# Only touched from the event loop, so no locking is needed.
+_faces = bytearray()
 
-def week_id(dt: Optional[date] = None) -> str:
-    d = dt or datetime.now(timezone.utc).date()
+
+def roll_d6() -> int:
+    if not _faces:
+        _faces.extend(1 + b % 6 for b in os.urandom(512) if b < 252)
+    return _faces.pop()
+
+
+# Current UTC date + ISO week, rebuilt only when the day rolls over (UTC epoch days are exactly 86400 s)
+_day_cache = [0.0, "", ""]  # [expires_at, 'YYYY-MM-DD', 'YYYY-Www']
+
+
+def _utc_day() -> list:
+    now = time.time()
+    if now >= _day_cache[0]:
+        d = datetime.fromtimestamp(now, timezone.utc).date()
+        _day_cache[:] = [(now // 86400 + 1) * 86400, d.isoformat(), _format_week(d)]
+    return _day_cache
+
+
+def _format_week(d: date) -> str:
     year, wk, _ = d.isocalendar()
     return f"{year}-W{wk:02d}"
 
 
-def rolls_used_today(user_id: int) -> int:
-    with db() as conn:
-        cur = conn.execute(
-            "SELECT COUNT(*) FROM rolls WHERE telegram_id=? AND date_utc=?",
-            (user_id, today_utc_str()),
-        )
-        return int(cur.fetchone()[0])
+def today_utc_str() -> str:
+    return _utc_day()[1]
 
 
-def seconds_since_last_roll(user_id: int) -> float:
-    with db() as conn:
-        cur = conn.execute(
-            "SELECT strftime('%s','now') - strftime('%s', MAX(created_at)) "
-            "FROM rolls WHERE telegram_id=?",
-            (user_id,),
-        )
-        val = cur.fetchone()[0]
-        try:
-            return float(val if val is not None else 10_000.0)
-        except Exception:
-            return 10_000.0
+def week_id(dt: Optional[date] = None) -> str:
+    return _format_week(dt) if dt else _utc_day()[2]
 
 
-def upsert_daily_and_weekly(user_id: int, add_total: int) -> None:
+async def rolls_used_today(conn: aiosqlite.Connection, user_id: int) -> int:
+    rows = await conn.execute_fetchall(SQL_COUNT_TODAY, (user_id, today_utc_str()))
+    return int(rows[0][0])
+
+
+async def upsert_daily_and_weekly(conn: aiosqlite.Connection, user_id: int, add_total: int) -> None:
     tday = today_utc_str()
     wk = week_id()
-    with db() as conn:
-        conn.execute(
-            """
-            INSERT INTO daily_totals(telegram_id, date_utc, total_score, rolls_count)
-            VALUES(?,?,?,1)
-            ON CONFLICT(telegram_id, date_utc) DO UPDATE SET
-              total_score = total_score + excluded.total_score,
-              rolls_count = rolls_count + 1
-        """,
-            (user_id, tday, add_total),
-        )
-        conn.execute(
-            """
-            INSERT INTO weekly_totals(telegram_id, week_id, total_score, days_played)
-            VALUES(?,?,?,0)
-            ON CONFLICT(telegram_id, week_id) DO UPDATE SET
-              total_score = total_score + excluded.total_score
-        """,
-            (user_id, wk, add_total),
-        )
-        conn.commit()
+    await conn.execute(SQL_UPSERT_DAILY, (user_id, tday, add_total))
+    await conn.execute(SQL_UPSERT_WEEKLY, (user_id, wk, add_total))
 
 
 def json_error(status: int, code: str, **extra):
-    return JSONResponse(status_code=status, content={"error": code, **extra})
+    return ORJSONResponse(status_code=status, content={"error": code, **extra})
 
 
-def get_idempo(conn: sqlite3.Connection, user_id: int, key: str):
-    cur = conn.execute(
-        "SELECT response_json FROM roll_requests WHERE telegram_id=? AND key=?",
-        (user_id, key),
-    )
-    row = cur.fetchone()
-    return json.loads(row[0]) if row else None
+async def get_idempo(conn: aiosqlite.Connection, user_id: int, key: str):
+    rows = await conn.execute_fetchall(SQL_GET_IDEMPO, (user_id, key))
+    return orjson.loads(rows[0][0]) if rows else None
 
 
-def save_idempo(conn: sqlite3.Connection, user_id: int, key: str, resp: dict):
-    conn.execute(
-        "INSERT OR IGNORE INTO roll_requests(telegram_id, key, response_json) VALUES (?,?,?)",
-        (user_id, key, json.dumps(resp, separators=(',', ':'))),
-    )
+async def save_idempo(conn: aiosqlite.Connection, user_id: int, key: str, resp: dict) -> bool:
+    # RETURNING yields a row only when the insert happened, so "stored" vs "already seen" costs no extra query
+    rows = await conn.execute_fetchall(SQL_SAVE_IDEMPO, (user_id, key, orjson.dumps(resp)))
+    return bool(rows)
+
+
+# Leaderboards barely move second-to-second: keep each (period, limit) top list for a couple of seconds
+# so K concurrent viewers cost one top-K query, plus their own cheap rank probe.
+_LB_CACHE: TTLCache = TTLCache(maxsize=64, ttl=2.0)
+
+
+async def top_leaderboard(conn: aiosqlite.Connection, sql: str, period: str, limit: int) -> list:
+    key = (period, limit)
+    top = _LB_CACHE.get(key)
+    if top is None:
+        rows = await conn.execute_fetchall(sql, (period, limit))
+        top = _LB_CACHE[key] = [{"rank": i, "user": str(uid), "score": sc} for i, (uid, sc) in enumerate(rows, 1)]
+    return top
+
+
+async def _your_rank(conn: aiosqlite.Connection, sql: str, period: str, viewer_id: int):
+    rows = await conn.execute_fetchall(sql, (period, viewer_id))
+    return tuple(rows[0]) if rows else (None, 0)
+
+
+async def _your_rank_daily(conn: aiosqlite.Connection, uid: int, tday: str):
+    return await _your_rank(conn, SQL_RANK_DAILY, tday, uid)
+
+
+async def _your_rank_weekly(conn: aiosqlite.Connection, uid: int, wk: str):
+    return await _your_rank(conn, SQL_RANK_WEEKLY, wk, uid)
 
 
 # ─────────────────────────────────────────────
 # Lightweight "user" source for now
 # In production: extract Telegram WebApp user from initData, or use your session.
-def _resolve_user_id(x_tg_id: Optional[str]) -> int:
-    try:
-        if x_tg_id and x_tg_id.isdigit():
-            return int(x_tg_id)
-    except Exception:
-        pass
-    return TEST_USER_ID
+# Used as a dependency; async so FastAPI resolves it inline instead of via the threadpool.
+async def resolve_user(x_tg_id: Optional[str] = Header(None)) -> int:
+    # isascii() rules out unicode digits like "²" that isdigit() accepts but int() rejects
+    return int(x_tg_id) if x_tg_id and x_tg_id.isascii() and x_tg_id.isdigit() else TEST_USER_ID
 
 
 # ─────────────────────────────────────────────
 # API
 
 @app.get("/config")
-def get_config(x_tg_id: Optional[str] = Header(None)):
-    user_id = _resolve_user_id(x_tg_id)
-    used = rolls_used_today(user_id)
+async def get_config(user_id: int = Depends(resolve_user), conn: aiosqlite.Connection = Depends(get_read_conn)):
+    used = await rolls_used_today(conn, user_id)
     return {
         "rolls_left": max(0, MAX_DAILY - used),
         "cooldown": COOLDOWN_S,
@@ -267,45 +499,33 @@ def get_config(x_tg_id: Optional[str] = Header(None)):
 
 
 @app.post("/roll")
-def roll_dice(request: Request, x_tg_id: Optional[str] = Header(None)):
-    user_id = _resolve_user_id(x_tg_id)
+async def roll_dice(request: Request, user_id: int = Depends(resolve_user)):
     idem_key = request.headers.get("X-Idempotency-Key")
 
-    # If an idempotency key is supplied and we have a stored response, return it
-    if idem_key:
-        with db() as conn:
-            prev = get_idempo(conn, user_id, idem_key)
+    # The whole check-and-insert runs on the shared writer, so concurrent rolls can't race the limits
+    async with write_conn() as conn:
+        # If an idempotency key is supplied and we have a stored response, return it
+        if idem_key:
+            prev = await get_idempo(conn, user_id, idem_key)
             if prev:
                 return prev
 
-    # cooldown
-    since = seconds_since_last_roll(user_id)
-    if since < COOLDOWN_S:
-        return json_error(429, "COOLDOWN_ACTIVE", seconds_remaining=round(COOLDOWN_S - since, 1))
-
-    # limit
-    used = rolls_used_today(user_id)
-    if used >= MAX_DAILY:
-        return json_error(400, "DAILY_LIMIT_REACHED", daily_limit=MAX_DAILY)
-
-    # server-side dice
-    d1 = random.randint(1, 6)
-    d2 = random.randint(1, 6)
-    total = d1 + d2
-    idx = used + 1
-    tday = today_utc_str()
-
-    with db() as conn:
-        conn.execute(
-            """
-            INSERT INTO rolls(telegram_id, date_utc, roll_index, d1, d2, total, created_at)
-            VALUES(?,?,?,?,?,?,datetime('now'))
-        """,
-            (user_id, tday, idx, d1, d2, total),
-        )
-        conn.commit()
-
-        upsert_daily_and_weekly(user_id, total)
+        # server-side dice, inserted only if the cooldown + daily limit allow it
+        tday = today_utc_str()
+        d1 = roll_d6()
+        d2 = roll_d6()
+        total = d1 + d2
+        rows = await conn.execute_fetchall(SQL_ROLL, (user_id, tday, d1, d2))
+        if not rows:
+            # refused: one diagnostic lookup tells cooldown from limit
+            (used, since), = await conn.execute_fetchall(SQL_ROLL_STATE, (user_id, tday))
+            since = float(since if since is not None else 10_000.0)
+            if since < COOLDOWN_S:
+                return json_error(429, "COOLDOWN_ACTIVE", seconds_remaining=round(COOLDOWN_S - since, 1))
+            return json_error(400, "DAILY_LIMIT_REACHED", daily_limit=MAX_DAILY)
+
+        idx = rows[0][0]
+        await upsert_daily_and_weekly(conn, user_id, total)
 
         resp = {
             "d1": d1,
@@ -316,61 +536,30 @@ def roll_dice(request: Request, x_tg_id: Optional[str] = Header(None)):
             "daily_limit": MAX_DAILY,
         }
 
-        # Save idempotent response (no-op if key missing)
-        if idem_key:
-            save_idempo(conn, user_id, idem_key, resp)
-            conn.commit()
+        # Save idempotent response in the same transaction as the roll; if the key was somehow
+        # stored first, undo this roll and replay the stored response instead
+        if idem_key and not await save_idempo(conn, user_id, idem_key, resp):
+            await conn.rollback()
+            return await get_idempo(conn, user_id, idem_key)
 
     return resp
 
 
 @app.get("/leaderboard/daily")
-def daily_leaderboard(limit: int = 20, x_tg_id: Optional[str] = Header(None)):
+async def daily_leaderboard(
+    limit: int = Query(20, ge=1, le=LEADERBOARD_MAX_LIMIT), viewer_id: int = Depends(resolve_user), conn: aiosqlite.Connection = Depends(get_read_conn)
+):
     tday = today_utc_str()
-    viewer_id = _resolve_user_id(x_tg_id)
-    with db() as conn:
-        top = conn.execute(
-            """
-            SELECT telegram_id, total_score FROM daily_totals
-            WHERE date_utc=? ORDER BY total_score DESC, telegram_id ASC
-            LIMIT ?
-        """,
-            (tday, limit),
-        ).fetchall()
-        rows = conn.execute(
-            """
-            SELECT telegram_id, total_score FROM daily_totals
-            WHERE date_utc=? ORDER BY total_score DESC, telegram_id ASC
-        """,
-            (tday,),
-        ).fetchall()
-    leaderboard = [{"rank": i + 1, "user": str(uid), "score": sc} for i, (uid, sc) in enumerate(top)]
-    your_rank = next((i + 1 for i, (uid, _) in enumerate(rows) if uid == viewer_id), None)
-    your_score = next((sc for uid, sc in rows if uid == viewer_id), 0)
-    return {"date": tday, "leaderboard": leaderboard, "your_rank": your_rank, "your_score": your_score}
+    leaderboard = await top_leaderboard(conn, SQL_TOP_DAILY, tday, limit)
+    my_rank, my_score = await _your_rank_daily(conn, viewer_id, tday)
+    return {"date": tday, "leaderboard": leaderboard, "your_rank": my_rank, "your_score": my_score}
 
 
 @app.get("/leaderboard/weekly")
-def weekly_leaderboard(limit: int = 20, x_tg_id: Optional[str] = Header(None)):
+async def weekly_leaderboard(
+    limit: int = Query(20, ge=1, le=LEADERBOARD_MAX_LIMIT), viewer_id: int = Depends(resolve_user), conn: aiosqlite.Connection = Depends(get_read_conn)
+):
     wk = week_id()
-    viewer_id = _resolve_user_id(x_tg_id)
-    with db() as conn:
-        top = conn.execute(
-            """
-            SELECT telegram_id, total_score FROM weekly_totals
-            WHERE week_id=? ORDER BY total_score DESC, telegram_id ASC
-            LIMIT ?
-        """,
-            (wk, limit),
-        ).fetchall()
-        rows = conn.execute(
-            """
-            SELECT telegram_id, total_score FROM weekly_totals
-            WHERE week_id=? ORDER BY total_score DESC, telegram_id ASC
-        """,
-            (wk,),
-        ).fetchall()
-    leaderboard = [{"rank": i + 1, "user": str(uid), "score": sc} for i, (uid, sc) in enumerate(top)]
-    your_rank = next((i + 1 for i, (uid, _) in enumerate(rows) if uid == viewer_id), None)
-    your_score = next((sc for uid, sc in rows if uid == viewer_id), 0)
-    return {"week_id": wk, "leaderboard": leaderboard, "your_rank": your_rank, "your_score": your_score}
+    leaderboard = await top_leaderboard(conn, SQL_TOP_WEEKLY, wk, limit)
+    my_rank, my_score = await _your_rank_weekly(conn, viewer_id, wk)
+    return {"week_id": wk, "leaderboard": leaderboard, "your_rank": my_rank, "your_score": my_score}
@@ -0,0 +1,16 @@
+# Gunicorn settings for production: `gunicorn -c New/gunicorn_conf.py New.main:fastapi_app`
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"  # uvloop + httptools per worker (uvicorn[standard])
+
+# Defaults to ONE worker on purpose: bot state (state.json), the in-memory caches, the roll cooldown map and the
+# per-chat update queues all live in-process, and every worker would re-register the webhook on startup.
+# Raise WEB_CONCURRENCY (e.g. 2×CPU) only once that state is shared/external; updates for a chat may then land
+# on any worker, so in-chat ordering is per-process only.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_connections = 1000
+keepalive = 75  # above typical LB idle timeouts so proxies don't hit half-closed sockets
+timeout = 60
+graceful_timeout = 40  # > main.SHUTDOWN_BUDGET_S (25s shared by update drain, bot stop, BG_TASKS) + state save/close
+accesslog = None
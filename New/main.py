@@ -1,18 +1,34 @@
 # === main.py (WebApp + caches + external wallet save + Dice API merged) ===
-import os, time, json, asyncio, sqlite3, requests, random, pathlib
+import os, io, time, json, string, asyncio, logging, sqlite3, requests, pathlib, threading
+import httpx
 from pathlib import Path
-from collections import defaultdict
+from collections import deque, OrderedDict
 from datetime import datetime, timezone, date
+from contextlib import asynccontextmanager
 from typing import Optional
 
 from dotenv import load_dotenv
 
+# JSON: orjson when installed (state is rewritten on most callbacks), stdlib otherwise — both yield UTF-8 bytes
+try:
+    import orjson
+    HAVE_ORJSON = True
+    def json_dumps(obj, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+    json_loads = orjson.loads
+except ImportError:
+    HAVE_ORJSON = False
+    def json_dumps(obj, indent: bool = False) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, indent=(2 if indent else None),
+                          separators=(None if indent else (",", ":"))).encode("utf-8")
+    json_loads = json.loads
+
 # Telegram
 from telegram import (
     Update,
     InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
-    WebAppInfo,
+    WebAppInfo, InputFile,
 )
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
@@ -20,15 +36,21 @@ from telegram.ext import (
 )
 
 # FastAPI
-from fastapi import FastAPI, Request, Header, HTTPException, Depends
+from fastapi import FastAPI, Request, Header, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
 from pydantic import BaseModel
 
 # ─────────────────────────────────────────────
 # Env
 load_dotenv()
+# One root handler for our logs and PTB's; httpx logs every request at INFO, so keep it to warnings.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log = logging.getLogger("bot")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
 PORT = int(os.getenv("PORT", "10000"))
 TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
@@ -36,12 +58,11 @@ TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ENJIN_API = os.getenv("ENJIN_GRAPHQL", "https://platform.enjin.io/graphql")
 ENJIN_API_KEY = os.getenv("ENJIN_API_KEY")
-WEBAPP_URL = os.getenv("WEBAPP_URL", "https://test-97pb.onrender.com/web/index.html").strip()  # e.g., https://your-domain.tld/web/index.html
 
 # External WebApp DB endpoint to save wallets
 WEBAPP_WALLET_ENDPOINT = os.getenv("WEBAPP_WALLET_ENDPOINT", "").strip()
 WEBAPP_API_KEY = os.getenv("WEBAPP_API_KEY", "").strip()
-PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+# e.g., https://your-domain.tld/web/index.html; defaults to this app's own /web when PUBLIC_URL is set
 WEBAPP_URL = (os.getenv("WEBAPP_URL", "").strip()
               or (f"{PUBLIC_URL}/web/index.html" if PUBLIC_URL else ""))
 
@@ -52,8 +73,6 @@ if not ENJIN_API_KEY:
 
 # ─────────────────────────────────────────────
 # In-memory state
-USER_ADDRESS: dict[int, str] = {}   # set in /connect
-USER_COLLECTION: dict[int, str] = {}
 AWAITING_FIND_FLAG = "awaiting_find_term"
 
 # Paging config
@@ -62,11 +81,17 @@ OWNED_PAGE_SIZE = 10
 PROGRESS_PAGE_SIZE = 20
 
 # TokenId cache (to speed up progress navigation)
-TOKEN_CACHE: dict[str, dict] = {}  # {cid: {"ids":[...], "ts": float}}
+TOKEN_CACHE: "OrderedDict[str, dict]" = OrderedDict()  # {cid: {"ids":[...], "ts": float}}, LRU order
 # ---- Fast caches ----
-OWNED_CACHE: dict[int, dict] = {}  # {telegram_user_id: {"ts": float, "owned": dict[str,set[str]]}}
+OWNED_CACHE: "OrderedDict[int, dict]" = OrderedDict()  # {telegram_user_id: {"ts": float, "owned": dict[str,frozenset[str]]}}
 OWNED_MAX_AGE = 300  # 5 minutes
 TOKEN_CACHE_MAX_AGE = 1800  # 30 minutes
+CACHE_MAX_ENTRIES = 512     # LRU cap for TOKEN_CACHE / OWNED_CACHE
+MEM_PRESSURE_LOW = 0.70     # above this share of RAM in use, cache TTLs start shrinking...
+MEM_PRESSURE_HIGH = 0.95    # ...down to the floor at this share
+NAME_RESOLVE_CONCURRENCY = 8  # in-flight name lookups when resolving many collections
+CONNECT_POLL_WINDOW = 120   # seconds to wait for a wallet scan in /connect
+CONNECT_POLL_MAX_DELAY = 8  # backoff cap between verification polls
 
 # Paths
 DATA_DIR = Path("data"); DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -78,28 +103,46 @@ COLLECTIONS_JSON = Path("collections.json")  # optional backup/export
 # ─────────────────────────────────────────────
 # Enjin config
 USE_BEARER = False
-def gql_headers():
-    if USE_BEARER:
-        tok = ENJIN_API_KEY if ENJIN_API_KEY.startswith("Bearer ") else f"Bearer {ENJIN_API_KEY}"
-    else:
-        tok = ENJIN_API_KEY
-    return {"Authorization": tok, "Content-Type": "application/json"}
+# Built once: the key and auth scheme don't change at runtime
+GQL_HEADERS = {
+    "Authorization": (f"Bearer {ENJIN_API_KEY}" if USE_BEARER and not ENJIN_API_KEY.startswith("Bearer ")
+                      else ENJIN_API_KEY),
+    "Content-Type": "application/json",
+}
+
+# Shared async client for non-Enjin calls (no Enjin auth header). Closed in the FastAPI shutdown hook.
+WEB_HTTP = httpx.AsyncClient(timeout=10, follow_redirects=True, http2=True,
+                             limits=httpx.Limits(max_keepalive_connections=100, max_connections=200))
+
+# Background tasks (fire-and-forget): strong refs so they aren't GC'd mid-flight; drained on shutdown
+BG_TASKS: set[asyncio.Task] = set()
+
+def _bg_done(task: asyncio.Task):
+    BG_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error("⚠️ Background task %s failed", task.get_name(), exc_info=task.exception())
+
+def spawn_bg(coro, name: str | None = None) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    BG_TASKS.add(task)
+    task.add_done_callback(_bg_done)
+    return task
 
 # OUTBOUND: save wallet to your WebApp DB
-def post_wallet_to_webapp(telegram_id: int, username: str | None, wallet: str) -> None:
+async def post_wallet_to_webapp(telegram_id: int, username: str | None, wallet: str) -> None:
     if not WEBAPP_WALLET_ENDPOINT:
-        print("ℹ️ WEBAPP_WALLET_ENDPOINT not set; skipping external wallet save.")
+        log.info("ℹ️ WEBAPP_WALLET_ENDPOINT not set; skipping external wallet save.")
         return
     payload = {"telegram_id": telegram_id, "username": username or "", "wallet_address": wallet}
     headers = {"Content-Type": "application/json"}
     if WEBAPP_API_KEY:
         headers["X-API-Key"] = WEBAPP_API_KEY
     try:
-        r = requests.post(WEBAPP_WALLET_ENDPOINT, json=payload, headers=headers, timeout=10)
-        if not r.ok:
-            print(f"⚠️ WebApp wallet save failed: {r.status_code} {r.text[:200]}")
-    except Exception as e:
-        print(f"⚠️ WebApp wallet save error: {e}")
+        r = await WEB_HTTP.post(WEBAPP_WALLET_ENDPOINT, json=payload, headers=headers)
+        if not r.is_success:
+            log.warning("⚠️ WebApp wallet save failed: %s %s", r.status_code, r.text[:200])
+    except Exception:
+        log.exception("⚠️ WebApp wallet save error")
 
 # ─────────────────────────────────────────────
 # State load/save
@@ -109,34 +152,58 @@ def load_state():
     global STATE
     if STATE_PATH.exists():
         try:
-            STATE = json.loads(STATE_PATH.read_text("utf-8"))
+            STATE = json_loads(STATE_PATH.read_bytes())
         except Exception:
             STATE = {"users": {}}
     else:
         STATE = {"users": {}}
-    for k, v in STATE.get("users", {}).items():
-        try:
-            uid = int(k)
-        except ValueError:
-            continue
-        if v.get("address"):
-            USER_ADDRESS[uid] = v["address"]
-        if v.get("collection"):
-            USER_COLLECTION[uid] = v["collection"]
 
 def save_state():
+    _write_state(json_dumps(STATE))
+
+def _write_state(data: bytes):
     try:
-        STATE_PATH.write_text(json.dumps(STATE, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        STATE_PATH.write_bytes(data)
     except Exception:
         pass
 
+# Handlers call schedule_save(): state changes within SAVE_DEBOUNCE_S coalesce into one file write,
+# done off the event loop. Shutdown flushes with save_state().
+SAVE_DEBOUNCE_S = 2.0
+_save_task: asyncio.Task | None = None
+
+def schedule_save():
+    global _save_task
+    if _save_task is None or _save_task.done():
+        try:
+            _save_task = asyncio.get_running_loop().create_task(_flush_state_later())
+        except RuntimeError:  # no running loop: write now
+            save_state()
+
+async def _flush_state_later():
+    global _save_task
+    await asyncio.sleep(SAVE_DEBOUNCE_S)
+    _save_task = None  # changes made from here on schedule a fresh flush
+    data = json_dumps(STATE)  # serialize on the loop so handlers can't mutate STATE mid-dump
+    await asyncio.to_thread(_write_state, data)
+
 def user_state(uid: int) -> dict:
-    u = STATE.setdefault("users", {}).setdefault(str(uid), {})
-    u.setdefault("address", USER_ADDRESS.get(uid))
-    u.setdefault("collection", USER_COLLECTION.get(uid))
-    u.setdefault("last_view", None)
+    users = STATE.setdefault("users", {})
+    u = users.get(str(uid))
+    if u is not None:  # warm user: already initialised below
+        return u
+    u = users[str(uid)] = {"address": None, "collection": None, "last_view": None}
     return u
 
+# Address/collection live only in STATE["users"] (no per-uid mirror dicts); lookups don't create entries
+def get_user_address(uid: int) -> str | None:
+    u = STATE.get("users", {}).get(str(uid))
+    return u.get("address") if u else None
+
+def get_user_collection(uid: int) -> str | None:
+    u = STATE.get("users", {}).get(str(uid))
+    return u.get("collection") if u else None
+
 load_state()
 
 # ─────────────────────────────────────────────
@@ -153,16 +220,18 @@ async def safe_reply(update: Update, text: str, reply_markup=None):
         return
     if len(text) <= MAX_CHUNK:
         return await update.message.reply_text(text, reply_markup=reply_markup)
-    lines = text.split("\n")
-    buf, cur = [], 0
+    if len(text) > 2 * MAX_CHUNK:  # long dumps: one document instead of a burst of messages
+        doc = InputFile(io.BytesIO(text.encode("utf-8")), filename="reply.txt")
+        return await update.message.reply_document(doc, reply_markup=reply_markup)
     first = True
-    for ln in lines:
-        if cur + len(ln) + 1 > MAX_CHUNK:
-            await update.message.reply_text("\n".join(buf), reply_markup=(reply_markup if first else None))
-            first = False; buf, cur = [], 0
-        buf.append(ln); cur += len(ln) + 1
-    if buf:
-        await update.message.reply_text("\n".join(buf))
+    while text:
+        # cut at the last newline that fits; hard cut when a single line is oversized
+        cut = text.rfind("\n", 0, MAX_CHUNK) if len(text) > MAX_CHUNK else len(text)
+        if cut <= 0:
+            cut = MAX_CHUNK
+        await update.message.reply_text(text[:cut], reply_markup=(reply_markup if first else None))
+        first = False
+        text = text[cut + 1:] if text[cut:cut + 1] == "\n" else text[cut:]
 
 async def edit_or_send(update: Update, text: str, reply_markup=None):
     if getattr(update, "callback_query", None):
@@ -175,8 +244,25 @@ async def edit_or_send(update: Update, text: str, reply_markup=None):
 
 # ─────────────────────────────────────────────
 # SQLite — collection.db & app.db
-def get_conn(path: Path):
-    return sqlite3.connect(path)
+# One long-lived connection per DB file per thread (event loop, to_thread workers, refresh pool):
+# no reopen + PRAGMA setup per query, warm page cache, and WAL keeps readers off the writers' lock.
+_DB_LOCAL = threading.local()
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",  # 64 MiB: hot pages read straight from the map
+)
+
+def get_conn(path: Path) -> sqlite3.Connection:
+    conns = _DB_LOCAL.__dict__.setdefault("conns", {})
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = sqlite3.connect(path, timeout=10)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+    return conn
 
 def init_collection_db():
     conn = get_conn(COLLECTION_DB)
@@ -190,55 +276,139 @@ def init_collection_db():
     )
     """)
     cur.execute("CREATE INDEX IF NOT EXISTS idx_col_name ON collections(name)")
-    conn.commit(); conn.close()
+    conn.commit()
+    init_collections_fts(conn)
+
+# Trigram FTS5 index over collections.name, kept in sync by triggers. Trigram (not word) tokens keep the
+# old substring semantics of LIKE '%term%', but LIKE on the FTS table is answered from the index.
+COLLECTIONS_FTS = False
+
+def init_collections_fts(conn: sqlite3.Connection):
+    global COLLECTIONS_FTS
+    fresh = conn.execute("SELECT 1 FROM sqlite_master WHERE name='collections_fts'").fetchone() is None
+    try:
+        with conn:
+            conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS collections_fts
+              USING fts5(name, content='collections', content_rowid='rowid', tokenize='trigram');
+            CREATE TRIGGER IF NOT EXISTS collections_fts_ai AFTER INSERT ON collections BEGIN
+              INSERT INTO collections_fts(rowid, name) VALUES (new.rowid, new.name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS collections_fts_ad AFTER DELETE ON collections BEGIN
+              INSERT INTO collections_fts(collections_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS collections_fts_au AFTER UPDATE OF name ON collections BEGIN
+              INSERT INTO collections_fts(collections_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+              INSERT INTO collections_fts(rowid, name) VALUES (new.rowid, new.name);
+            END;
+            """)
+            if fresh:
+                conn.execute("INSERT INTO collections_fts(collections_fts) VALUES ('rebuild')")  # backfill
+        COLLECTIONS_FTS = True
+    except sqlite3.OperationalError as e:  # SQLite built without FTS5 / trigram (< 3.34)
+        log.info("ℹ️ Collection search index unavailable (%s); using LIKE scan.", e)
 
 def collections_upsert(rows: list[tuple[str, str]]):
     if not rows: return
     now = int(time.time())
-    conn = get_conn(COLLECTION_DB)
-    cur = conn.cursor()
-    cur.executemany("""
-        INSERT INTO collections(id, name, created_at, updated_at)
-        VALUES(?,?,?,?)
-        ON CONFLICT(id) DO UPDATE SET
-          name=excluded.name,
-          updated_at=excluded.updated_at
-    """, [(str(cid), (nm or f"Collection {cid}"), now, now) for cid, nm in rows])
-    conn.commit(); conn.close()
-
-def collections_bulk_insert_ids(ids: list[str]):
-    if not ids: return
+    with get_conn(COLLECTION_DB) as conn:  # commit, or roll back so the shared connection isn't left mid-transaction
+        conn.execute("BEGIN IMMEDIATE")  # take the write lock up front: one lock + one WAL commit per batch
+        conn.executemany("""
+            INSERT INTO collections(id, name, created_at, updated_at)
+            VALUES(?,?,?,?)
+            ON CONFLICT(id) DO UPDATE SET
+              name=excluded.name,
+              updated_at=excluded.updated_at
+        """, [(str(cid), (nm or f"Collection {cid}"), now, now) for cid, nm in rows])
+
+def collections_fill_missing(rows: list[tuple[str, str]]):
+    # Backup/restore path: adds unknown ids and fills exact "Collection <id>" placeholders, never replaces a resolved name.
+    if not rows: return
     now = int(time.time())
-    conn = get_conn(COLLECTION_DB); cur = conn.cursor()
-    cur.executemany("""
-        INSERT OR IGNORE INTO collections(id, name, created_at, updated_at)
-        VALUES(?,?,?,?)
-    """, [(str(cid), f"Collection {cid}", now, now) for cid in ids])
-    conn.commit(); conn.close()
+    with get_conn(COLLECTION_DB) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("""
+            INSERT INTO collections(id, name, created_at, updated_at)
+            VALUES(?,?,?,?)
+            ON CONFLICT(id) DO UPDATE SET
+              name=excluded.name,
+              updated_at=excluded.updated_at
+            WHERE collections.name = 'Collection ' || collections.id
+        """, [(str(cid), (nm or f"Collection {cid}"), now, now) for cid, nm in rows])
+
+def collections_bulk_insert_ids(ids: list[str], pick_unnamed: int = 0) -> list[str]:
+    # Inserts placeholders and (optionally) returns the oldest still-unnamed ids in the same transaction.
+    if not ids: return []
+    now = int(time.time())
+    todo = []
+    with get_conn(COLLECTION_DB) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.cursor()
+        cur.executemany("""
+            INSERT OR IGNORE INTO collections(id, name, created_at, updated_at)
+            VALUES(?,?,?,?)
+        """, [(str(cid), f"Collection {cid}", now, now) for cid in ids])
+        if pick_unnamed:
+            cur.execute("""
+                SELECT id FROM collections
+                WHERE name LIKE 'Collection %'
+                ORDER BY updated_at ASC
+                LIMIT ?
+            """, (pick_unnamed,))
+            todo = [r[0] for r in cur.fetchall()]
+    return todo
 
 def collections_get_name(cid: str) -> str | None:
     conn = get_conn(COLLECTION_DB); cur = conn.cursor()
     cur.execute("SELECT name FROM collections WHERE id=?", (str(cid),))
-    row = cur.fetchone(); conn.close()
+    row = cur.fetchone()
     return row[0] if row else None
 
-def collections_search(term: str, limit: int = 400) -> list[tuple[str, str]]:
+def collections_get_names(cids: list[str]) -> dict[str, str]:
+    # One IN (...) query per 500 ids (stays under SQLite's bound-parameter limit) instead of one query per id
+    out: dict[str, str] = {}
+    cids = [str(c) for c in cids]
+    conn = get_conn(COLLECTION_DB)
+    for i in range(0, len(cids), 500):
+        chunk = cids[i:i + 500]
+        cur = conn.execute(f"SELECT id, name FROM collections WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        out.update(cur.fetchall())
+    return out
+
+def collections_search(term: str, limit: int = 400, offset: int = 0) -> list[tuple[str, str]]:
+    # (name, id) order is total, so LIMIT/OFFSET pages are stable
     like = f"%{term}%"
     conn = get_conn(COLLECTION_DB); cur = conn.cursor()
-    cur.execute("""
-        SELECT id, name FROM collections
-        WHERE LOWER(name) LIKE LOWER(?)
-        ORDER BY name ASC
-        LIMIT ?
-    """, (like, limit))
-    rows = cur.fetchall(); conn.close()
+    if COLLECTIONS_FTS:
+        cur.execute("""
+            SELECT c.id, c.name FROM collections_fts f JOIN collections c ON c.rowid = f.rowid
+            WHERE f.name LIKE ?
+            ORDER BY c.name ASC, c.id ASC
+            LIMIT ? OFFSET ?
+        """, (like, limit, offset))
+    else:
+        cur.execute("""
+            SELECT id, name FROM collections
+            WHERE LOWER(name) LIKE LOWER(?)
+            ORDER BY name ASC, id ASC
+            LIMIT ? OFFSET ?
+        """, (like, limit, offset))
+    rows = cur.fetchall()
     return [(r[0], r[1]) for r in rows]
 
+def collections_search_count(term: str) -> int:
+    like = f"%{term}%"
+    conn = get_conn(COLLECTION_DB)
+    if COLLECTIONS_FTS:
+        row = conn.execute("SELECT COUNT(*) FROM collections_fts WHERE name LIKE ?", (like,)).fetchone()
+    else:
+        row = conn.execute("SELECT COUNT(*) FROM collections WHERE LOWER(name) LIKE LOWER(?)", (like,)).fetchone()
+    return int(row[0])
+
 def collections_all_ids() -> list[str]:
     conn = get_conn(COLLECTION_DB); cur = conn.cursor()
     cur.execute("SELECT id FROM collections")
     out = [r[0] for r in cur.fetchall()]
-    conn.close()
     return out
 
 # app.db for generic user cache (kept)
@@ -253,44 +423,40 @@ def init_app_db():
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     """)
-    conn.commit(); conn.close()
+    conn.commit()
 
 init_collection_db()
 init_app_db()
 
 # Wallet cache helpers (kept)
 def cache_user_wallet(user_id: int, username: str | None, wallet: str | None):
-    conn = get_conn(APP_DB)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO users (user_id, username, wallet, updated_at)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(user_id) DO UPDATE SET
-          username=excluded.username,
-          wallet=COALESCE(excluded.wallet, users.wallet),
-          updated_at=CURRENT_TIMESTAMP
-    """, (user_id, username, wallet))
-    conn.commit()
-    conn.close()
+    with get_conn(APP_DB) as conn:
+        conn.execute("""
+            INSERT INTO users (user_id, username, wallet, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+              username=excluded.username,
+              wallet=COALESCE(excluded.wallet, users.wallet),
+              updated_at=CURRENT_TIMESTAMP
+        """, (user_id, username, wallet))
 
 def get_cached_wallet(user_id: int) -> str | None:
     conn = get_conn(APP_DB)
     cur = conn.cursor()
     cur.execute("SELECT wallet FROM users WHERE user_id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row[0] if row and row[0] else None
 
 # JSON backup helpers
 def load_collections_json() -> list[dict]:
     try:
-        return json.loads(COLLECTIONS_JSON.read_text("utf-8"))
+        return json_loads(COLLECTIONS_JSON.read_bytes())
     except Exception:
         return []
 
 def save_collections_json(entries: list[dict]):
     try:
-        COLLECTIONS_JSON.write_text(json.dumps(entries, ensure_ascii=False, indent=2), encoding="utf-8")
+        COLLECTIONS_JSON.write_bytes(json_dumps(entries, indent=True))
     except Exception:
         pass
 
@@ -302,204 +468,316 @@ def sync_json_from_db_if_needed():
         conn = get_conn(COLLECTION_DB); cur = conn.cursor()
         cur.execute("SELECT id, name FROM collections ORDER BY name ASC")
         entries = [{"id": r[0], "name": r[1]} for r in cur.fetchall()]
-        conn.close()
         save_collections_json(entries)
 
 # ─────────────────────────────────────────────
 # Enjin GraphQL helpers
+# GraphQL documents (module-level so every call reuses the same string)
+_Q_ADD_TO_TRACKED = """
+mutation Track($ids: [String!]!) {
+  AddToTracked(type: COLLECTION, chainIds: $ids)
+}
+"""
+_Q_COLLECTION_META = """
+query GetCollectionMeta($cid: BigInt!) {
+  GetCollection(collectionId: $cid) { attributes { key value } }
+}
+"""
+_Q_WALLET_TOKENS = """
+query WalletTokens($account: String, $after: String) {
+  GetWallet(account: $account) {
+    tokenAccounts(after: $after, first: 200) {
+      pageInfo { endCursor hasNextPage }
+      edges {
+        node {
+          balance
+          reservedBalance
+          token { tokenId collection { collectionId } }
+        }
+      }
+    }
+  }
+}
+"""
+_Q_COLLECTION_TOKENS = """
+query GetCollectionTokens($cid: BigInt!, $after: String) {
+  GetCollection(collectionId: $cid) {
+    tokens(after: $after) {
+      pageInfo { endCursor hasNextPage }
+      edges { node { tokenId } }
+    }
+  }
+}
+"""
+_Q_VERIFY_STATUS = "query GetAccountVerified($vid: String) { GetAccountVerified(verificationId: $vid) { verified } }"
+_Q_VERIFIED_ACCOUNT = """
+query GetAccountVerified($vid: String) {
+  GetAccountVerified(verificationId: $vid) { verified account { address } }
+}
+"""
+_Q_REQUEST_ACCOUNT = "query { RequestAccount { qrCode verificationId } }"
+_Q_GET_COLLECTIONS = """
+query GetCollections($after: String, $first: Int = 200) {
+  GetCollections(after: $after, first: $first) {
+    edges { node { collectionId attributes { key value } } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+
+# Sync path (called from worker threads): one pooled session, so queries reuse keep-alive TLS connections
+# instead of a fresh handshake per requests.post.
+ENJIN_SESSION = requests.Session()
+ENJIN_SESSION.headers.update(GQL_HEADERS)
+ENJIN_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def enjin_graphql(query: str, variables: dict | None = None) -> dict:
-    r = requests.post(ENJIN_API, json={"query": query, "variables": variables or {}}, headers=gql_headers(), timeout=30)
+    r = ENJIN_SESSION.post(ENJIN_API, json={"query": query, "variables": variables or {}}, timeout=30)
     r.raise_for_status()
     body = r.json()
     if "errors" in body:
         raise RuntimeError(str(body["errors"]))
     return body["data"]
 
+# Shared async client: keep-alive HTTP/2 connections to Enjin, awaited natively (no thread hop per query).
+# Closed in the FastAPI shutdown hook.
+ENJIN_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    headers=GQL_HEADERS,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+)
+
 async def enjin_graphql_async(query: str, variables: dict | None = None) -> dict:
-    def _do():
-        r = requests.post(
-            ENJIN_API,
-            json={"query": query, "variables": variables or {}},
-            headers=gql_headers(),
-            timeout=30,
-        )
-        r.raise_for_status()
-        body = r.json()
-        if "errors" in body:
-            raise RuntimeError(str(body["errors"]))
-        return body["data"]
-    return await asyncio.to_thread(_do)
+    r = await ENJIN_HTTP.post(ENJIN_API, json={"query": query, "variables": variables or {}})
+    r.raise_for_status()
+    body = r.json()
+    if "errors" in body:
+        raise RuntimeError(str(body["errors"]))
+    return body["data"]
 
 def add_to_tracked(collection_ids: list[str]) -> None:
     if not collection_ids: return
-    m = """
-    mutation Track($ids: [String!]!) {
-      AddToTracked(type: COLLECTION, chainIds: $ids)
-    }
-    """
     try:
-        enjin_graphql(m, {"ids": [str(c) for c in collection_ids]})
+        enjin_graphql(_Q_ADD_TO_TRACKED, {"ids": [str(c) for c in collection_ids]})
     except Exception:
         pass
 
-def _attr(attrs, key):
+def _attrs_index(attrs) -> dict:
+    # {lowercased key: value}; first occurrence wins, like the old linear scan
+    idx = {}
     for a in attrs or []:
-        if (a.get("key") or "").lower() == key.lower():
-            return a.get("value")
+        idx.setdefault((a.get("key") or "").lower(), a.get("value"))
+    return idx
+
+def _name_from_metadata(data) -> str | None:
+    if not isinstance(data, dict):
+        return None
+    if isinstance(data.get("name"), str) and data["name"].strip():
+        return data["name"].strip()
+    attrs2 = data.get("attributes")
+    if isinstance(attrs2, dict):
+        v = attrs2.get("name")
+        if isinstance(v, dict) and isinstance(v.get("value"), str) and v["value"].strip():
+            return v["value"].strip()
+    if isinstance(attrs2, list):
+        for it in attrs2:
+            if it.get("key") == "name" and isinstance(it.get("value"), str) and it["value"].strip():
+                return it["value"].strip()
     return None
 
-def resolve_name_via_attributes_or_uri(cid: str) -> str | None:
-    q = """
-    query GetCollectionMeta($cid: BigInt!) {
-      GetCollection(collectionId: $cid) { attributes { key value } }
-    }
-    """
+async def resolve_name_async(cid: str) -> str | None:
+    # Metadata URIs go through the pooled WEB_HTTP client; backoff awaits instead of blocking the loop
     attrs = []
     try:
-        attrs = enjin_graphql(q, {"cid": int(cid)})["GetCollection"].get("attributes") or []
+        attrs = (await enjin_graphql_async(_Q_COLLECTION_META, {"cid": int(cid)}))["GetCollection"].get("attributes") or []
     except Exception:
         pass
-    nm = _attr(attrs, "name")
+    idx = _attrs_index(attrs)
+    nm = idx.get("name")
     if isinstance(nm, str) and nm.strip():
         return nm.strip()
-    uri = _attr(attrs, "uri")
+    uri = idx.get("uri")
     if isinstance(uri, str) and uri.strip():
         for attempt in range(4):
             try:
-                r = requests.get(uri, headers={"Accept":"application/json","User-Agent":"ECT/1.0"}, timeout=20)
+                r = await WEB_HTTP.get(uri, headers={"Accept":"application/json","User-Agent":"ECT/1.0"}, timeout=20)
                 if r.status_code in (429, 500, 502, 503, 504):
-                    time.sleep(1.1 * (attempt + 1)); continue
-                if not r.ok:
+                    await asyncio.sleep(1.1 * (attempt + 1)); continue
+                if not r.is_success:
                     break
-                data = r.json()
-                if isinstance(data.get("name"), str) and data["name"].strip():
-                    return data["name"].strip()
-                attrs2 = data.get("attributes")
-                if isinstance(attrs2, dict):
-                    v = attrs2.get("name")
-                    if isinstance(v, dict) and isinstance(v.get("value"), str) and v["value"].strip():
-                        return v["value"].strip()
-                if isinstance(attrs2, list):
-                    for it in attrs2:
-                        if it.get("key") == "name" and isinstance(it.get("value"), str) and it["value"].strip():
-                            return it["value"].strip()
-                break
+                return _name_from_metadata(r.json())
             except Exception:
-                time.sleep(0.7 * (attempt + 1))
+                await asyncio.sleep(0.7 * (attempt + 1))
     return None
 
-def resolve_and_store_name(cid: str) -> str:
-    nm = collections_get_name(cid)
-    if nm: return nm
-    name = resolve_name_via_attributes_or_uri(cid) or f"Collection {cid}"
-    collections_upsert([(cid, name)])
+async def resolve_names_async(cids: list[str]) -> list[str | None]:
+    sem = asyncio.Semaphore(NAME_RESOLVE_CONCURRENCY)
+    async def _one(cid):
+        async with sem:
+            return await resolve_name_async(cid)
+    return await asyncio.gather(*(_one(c) for c in cids))
+
+def _store_names(rows: list[tuple[str, str]]):
+    collections_upsert(rows)
     entries = load_collections_json()
-    if not any(e.get("id") == cid for e in entries):
-        entries.append({"id": cid, "name": name}); save_collections_json(entries)
-    return name
+    seen = {e.get("id") for e in entries}
+    added = [{"id": cid, "name": name} for cid, name in rows if cid not in seen]
+    if added:
+        entries.extend(added); save_collections_json(entries)
+
+async def resolve_and_store_names(cids: list[str]) -> dict[str, str]:
+    # Known names come from the DB; the rest resolve concurrently and are persisted in one batch.
+    names = collections_get_names(cids)
+    todo = list(dict.fromkeys(c for c in cids if c not in names))
+    if todo:
+        resolved = await resolve_names_async(todo)
+        rows = [(cid, nm or f"Collection {cid}") for cid, nm in zip(todo, resolved)]
+        await asyncio.to_thread(_store_names, rows)
+        names.update(rows)
+    return names
+
+async def resolve_and_store_name(cid: str) -> str:
+    return (await resolve_and_store_names([cid]))[cid]
 
 # Wallet/token helpers
 def fetch_all_token_accounts(address: str) -> list[dict]:
-    q = """
-    query WalletTokens($account: String, $after: String) {
-      GetWallet(account: $account) {
-        tokenAccounts(after: $after, first: 200) {
-          pageInfo { endCursor hasNextPage }
-          edges {
-            node {
-              balance
-              reservedBalance
-              token { tokenId collection { collectionId } }
-            }
-          }
-        }
-      }
-    }
-    """
     edges, after = [], None
     while True:
-        d = enjin_graphql(q, {"account": address, "after": after})["GetWallet"]["tokenAccounts"]
+        d = enjin_graphql(_Q_WALLET_TOKENS, {"account": address, "after": after})["GetWallet"]["tokenAccounts"]
         edges.extend(d["edges"])
         if not d["pageInfo"]["hasNextPage"]:
             break
         after = d["pageInfo"]["endCursor"]
     return edges
 
-async def _fetch_owned_map(address: str) -> dict[str, set[str]]:
-    q = """
-    query WalletTokens($account: String, $after: String) {
-      GetWallet(account: $account) {
-        tokenAccounts(after: $after, first: 200) {
-          pageInfo { endCursor hasNextPage }
-          edges {
-            node {
-              balance
-              reservedBalance
-              token { tokenId collection { collectionId } }
-            }
-          }
-        }
-      }
-    }
-    """
-    owned: dict[str, set[str]] = defaultdict(set)
-    after = None
-    while True:
-        data = await enjin_graphql_async(q, {"account": address, "after": after})
-        ta = data["GetWallet"]["tokenAccounts"]
-        for e in ta["edges"]:
-            n = e["node"]
-            if int(n.get("balance") or 0) + int(n.get("reservedBalance") or 0) > 0:
-                cid = str(n["token"]["collection"]["collectionId"])
-                tid = str(n["token"]["tokenId"])
-                owned[cid].add(tid)
-        if not ta["pageInfo"]["hasNextPage"]:
-            break
-        after = ta["pageInfo"]["endCursor"]
-    return owned
+async def _fetch_owned_map(address: str) -> dict[str, frozenset[str]]:
+    # Cursor pages can't be forked, so double-buffer: launch page N+1 as soon as N's endCursor is known,
+    # then merge page N while N+1 is in flight.
+    async def _one_page(after):
+        data = await enjin_graphql_async(_Q_WALLET_TOKENS, {"account": address, "after": after})
+        return data["GetWallet"]["tokenAccounts"]
+
+    owned_lists: dict[str, list[str]] = {}
+    pending = asyncio.ensure_future(_one_page(None))
+    try:
+        while pending:
+            ta = await pending
+            pending = None
+            if ta["pageInfo"]["hasNextPage"]:
+                pending = asyncio.ensure_future(_one_page(ta["pageInfo"]["endCursor"]))
+                await asyncio.sleep(0)  # let the next request go out before we merge this page
+            for e in ta["edges"]:
+                n = e["node"]
+                # BigInt balances arrive as decimal strings: compare to "0" instead of parsing (0/None fall to "0" too)
+                if (n.get("balance") or "0") != "0" or (n.get("reservedBalance") or "0") != "0":
+                    tok = n["token"]
+                    owned_lists.setdefault(str(tok["collection"]["collectionId"]), []).append(str(tok["tokenId"]))
+    finally:
+        if pending:
+            pending.cancel()
+    return {cid: frozenset(tids) for cid, tids in owned_lists.items()}
+
+_MEM_SAMPLE = [0.0, 1.0]  # [sampled_at, ttl_scale]
+
+def cache_ttl_scale() -> float:
+    # Shrink TTLs linearly between LOW and HIGH memory use (MemAvailable from /proc, no psutil); re-sampled every 10s
+    now = time.time()
+    if now - _MEM_SAMPLE[0] < 10:
+        return _MEM_SAMPLE[1]
+    scale = 1.0
+    try:
+        info = {}
+        with open("/proc/meminfo", "rb") as f:
+            for line in f:
+                k, v = line.split(b":", 1)
+                info[k] = int(v.split()[0])
+        used = 1 - info[b"MemAvailable"] / info[b"MemTotal"]
+        m = min(1.0, max(0.0, (used - MEM_PRESSURE_LOW) / (MEM_PRESSURE_HIGH - MEM_PRESSURE_LOW)))
+        scale = max(0.1, 1 - m)
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+    _MEM_SAMPLE[:] = [now, scale]
+    return scale
+
+_LRU_LOCK = threading.Lock()  # token fetches run in to_thread workers as well as on the loop
+
+def _lru_get(cache: OrderedDict, key):
+    with _LRU_LOCK:
+        ent = cache.get(key)
+        if ent is not None:
+            cache.move_to_end(key)
+        return ent
+
+def _lru_put(cache: OrderedDict, key, value):
+    with _LRU_LOCK:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
 
 def _owned_cache_get(uid: int):
-    ent = OWNED_CACHE.get(uid)
-    if ent and (time.time() - ent["ts"] < OWNED_MAX_AGE):
+    ent = _lru_get(OWNED_CACHE, uid)
+    if ent and (time.time() - ent["ts"] < OWNED_MAX_AGE * cache_ttl_scale()):
         return ent["owned"]
     return None
 
-def _owned_cache_put(uid: int, owned_map: dict[str, set[str]]):
-    OWNED_CACHE[uid] = {"ts": time.time(), "owned": owned_map}
+def _owned_cache_put(uid: int, owned_map: dict[str, frozenset[str]]):
+    _lru_put(OWNED_CACHE, uid, {"ts": time.time(), "owned": owned_map})
 
 async def refresh_owned_cache(uid: int, address: str):
     owned = await _fetch_owned_map(address)
     _owned_cache_put(uid, owned)
     return owned
 
-def get_wallet_owned_by_collection(address: str) -> dict[str, set[str]]:
-    owned: dict[str, set[str]] = defaultdict(set)
+def get_wallet_owned_by_collection(address: str) -> dict[str, frozenset[str]]:
+    owned_lists: dict[str, list[str]] = {}
     for e in fetch_all_token_accounts(address):
         n = e["node"]
-        if int(n.get("balance") or 0) + int(n.get("reservedBalance") or 0) > 0:
-            cid = str(n["token"]["collection"]["collectionId"])
-            tid = str(n["token"]["tokenId"])
-            owned[cid].add(tid)
-    return owned
+        if (n.get("balance") or "0") != "0" or (n.get("reservedBalance") or "0") != "0":
+            tok = n["token"]
+            owned_lists.setdefault(str(tok["collection"]["collectionId"]), []).append(str(tok["tokenId"]))
+    return {cid: frozenset(tids) for cid, tids in owned_lists.items()}
 
 def sort_token_ids(ids: list[str]) -> list[str]:
+    # All-numeric ids (the usual case) sort with the C-level int key — no Python call or tuple per element.
+    # Token ids are u128 on Enjin, so a fixed-width NumPy sort isn't an option.
+    if all(map(str.isdigit, ids)):
+        return sorted(ids, key=int)
     def keyfn(s: str): return (0, int(s)) if s.isdigit() else (1, s)
     return sorted(ids, key=keyfn)
 
+# Persisted token-id lists: canonical numeric ids are stored as sorted ranges ("1-40,42,50-61"), which is
+# far smaller than a JSON list for typical mostly-contiguous collections; anything else stays a plain list.
+def _canonical_int(s: str) -> bool:
+    return s.isascii() and s.isdigit() and (s[0] != "0" or s == "0")
+
+def pack_token_ids(ids) -> str | list[str]:
+    if not all(map(_canonical_int, ids)):
+        return sort_token_ids(list(ids))
+    nums = sorted(map(int, ids))
+    parts, i = [], 0
+    while i < len(nums):
+        j = i
+        while j + 1 < len(nums) and nums[j + 1] == nums[j] + 1:
+            j += 1
+        parts.append(str(nums[i]) if i == j else f"{nums[i]}-{nums[j]}")
+        i = j + 1
+    return ",".join(parts)
+
+def unpack_token_ids(packed) -> list[str]:
+    if not isinstance(packed, str):
+        return list(packed or [])
+    out = []
+    for part in filter(None, packed.split(",")):
+        a, _, b = part.partition("-")
+        out.extend(map(str, range(int(a), int(b or a) + 1)))
+    return out
+
 def get_collection_token_ids(cid: str, page_cap: int = 20000) -> list[str]:
-    q = """
-    query GetCollectionTokens($cid: BigInt!, $after: String) {
-      GetCollection(collectionId: $cid) {
-        tokens(after: $after) {
-          pageInfo { endCursor hasNextPage }
-          edges { node { tokenId } }
-        }
-      }
-    }
-    """
     out, after = [], None
     while True:
-        d = enjin_graphql(q, {"cid": int(cid), "after": after})["GetCollection"]["tokens"]
+        d = enjin_graphql(_Q_COLLECTION_TOKENS, {"cid": int(cid), "after": after})["GetCollection"]["tokens"]
         out.extend([str(edge["node"]["tokenId"]) for edge in d["edges"]])
         if not d["pageInfo"]["hasNextPage"] or len(out) >= page_cap:
             break
@@ -508,18 +786,33 @@ def get_collection_token_ids(cid: str, page_cap: int = 20000) -> list[str]:
 
 def get_collection_token_ids_cached(cid: str, max_age_sec: int = TOKEN_CACHE_MAX_AGE, force: bool = False) -> list[str]:
     now = time.time()
-    ent = TOKEN_CACHE.get(cid)
-    if (not force) and ent and (now - ent.get("ts", 0) < max_age_sec):
+    ent = _lru_get(TOKEN_CACHE, cid)
+    if (not force) and ent and (now - ent.get("ts", 0) < max_age_sec * cache_ttl_scale()):
         return ent["ids"]
     ids = get_collection_token_ids(cid)
     ids_sorted = sort_token_ids(ids)
-    TOKEN_CACHE[cid] = {"ids": ids_sorted, "ts": now}
+    _lru_put(TOKEN_CACHE, cid, {"ids": ids_sorted, "ts": now})
     return ids_sorted
 
-def filter_ids(ids: list[str], have_set: set[str], mode: str) -> list[str]:
-    if mode == "missing": return [t for t in ids if t not in have_set]
-    if mode == "owned":   return [t for t in ids if t in have_set]
-    return ids
+def progress_views(s: dict) -> dict[str, list[str]]:
+    # Owned/missing splits are built once per (ids, have) pair and reused on every page turn / mode toggle
+    all_ids: list[str] = s.get("ids") or []
+    have_set: frozenset[str] = s.get("have") or frozenset()
+    v = s.get("_views")
+    if not v or v[0] is not all_ids or v[1] is not have_set:
+        owned = [t for t in all_ids if t in have_set]
+        missing = [t for t in all_ids if t not in have_set]
+        v = s["_views"] = (all_ids, have_set, {"all": all_ids, "owned": owned, "missing": missing})
+    return v[2]
+
+def packed_progress(s: dict) -> tuple:
+    # Range-packed (ids, have) for STATE, memoised like _views: packing sorts everything, so only redo it
+    # when the underlying list/frozenset objects change, not on every page turn
+    all_ids, have_set = s.get("ids") or [], s.get("have") or frozenset()
+    p = s.get("_packed")
+    if not p or p[0] is not all_ids or p[1] is not have_set:
+        p = s["_packed"] = (all_ids, have_set, pack_token_ids(all_ids), pack_token_ids(have_set))
+    return p[2], p[3]
 
 def next_mode(mode: str) -> str:
     return {"all": "missing", "missing": "owned", "owned": "all"}.get(mode or "all", "all")
@@ -539,40 +832,47 @@ def show_main_keyboard(update: Update, text: str = "What would you like to do?")
 
 # ─────────────────────────────────────────────
 # Inline keyboards & renderers (Find / Owned / Progress)
-def build_find_keyboard(matches: list[tuple[str, str]], page: int) -> InlineKeyboardMarkup:
-    total = len(matches)
-    start, end = page * PAGE_SIZE, min((page + 1) * PAGE_SIZE, total)
-    rows = [[InlineKeyboardButton(f"{name} ({cid})", callback_data=f"setcol:{cid}")]
-            for cid, name in matches[start:end]]
+def build_find_keyboard(page_rows: list[tuple[str, str]], page: int, has_more: bool) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(f"{nm or f'Collection {cid}'} ({cid})", callback_data=f"setcol:{cid}")]
+            for cid, nm in page_rows]
     nav = []
     if page > 0: nav.append(InlineKeyboardButton("⬅️ Prev", callback_data="find:prev"))
-    if end < total: nav.append(InlineKeyboardButton("Next ➡️", callback_data="find:next"))
+    if has_more: nav.append(InlineKeyboardButton("Next ➡️", callback_data="find:next"))
     if nav: rows.append(nav)
     rows.append([InlineKeyboardButton("❌ Close", callback_data="find:close")])
     return InlineKeyboardMarkup(rows)
 
-async def render_find_page(update: Update, context: ContextTypes.DEFAULT_TYPE, edit: bool = False):
+async def render_find_page(update: Update, context: ContextTypes.DEFAULT_TYPE, edit: bool = False, target=None):
     s = context.user_data.get("find") or {}
-    matches = s.get("matches") or []
+    # Only the term/page/total are kept; each page is re-queried with one extra row to detect a next page.
+    # (States saved before that held a "matches" list and no total.)
     page = int(s.get("page") or 0)
     term = s.get("term", "")
-    total_pages = max(1, (len(matches) + PAGE_SIZE - 1) // PAGE_SIZE)
-    kb = build_find_keyboard(matches, page)
-    title = f"Results for “{term}” — {len(matches)} total (page {page+1}/{total_pages})"
-    if edit and getattr(update, "callback_query", None):
+    if "total" not in s:
+        s["total"] = collections_search_count(term)
+    total = s["total"]
+    page_rows = collections_search(term, limit=PAGE_SIZE + 1, offset=page * PAGE_SIZE)
+    s["has_more"] = len(page_rows) > PAGE_SIZE
+    kb = build_find_keyboard(page_rows[:PAGE_SIZE], page, s["has_more"])
+    total_pages = max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+    title = f"Results for “{term}” — {total} total (page {page+1}/{total_pages})"
+    if target is not None:
+        await target.edit_text(title, reply_markup=kb)
+    elif edit and getattr(update, "callback_query", None):
         await edit_or_send(update, title, reply_markup=kb)
     else:
         await update.message.reply_text(title, reply_markup=kb)
     uid = update.effective_user.id
-    u = user_state(uid); u["last_view"] = "find"; u["find"] = {"term": term, "matches": matches, "page": page}
-    save_state()
+    u = user_state(uid); u["last_view"] = "find"; u["find"] = {"term": term, "page": page, "total": total}
+    schedule_save()
 
 def build_owned_keyboard(rows_in: list[tuple[str, int]], page: int) -> InlineKeyboardMarkup:
     total = len(rows_in)
     start, end = page * OWNED_PAGE_SIZE, min((page + 1) * OWNED_PAGE_SIZE, total)
     rows = []
+    names = collections_get_names([cid for cid, _ in rows_in[start:end]])
     for cid, cnt in rows_in[start:end]:
-        nm = collections_get_name(cid) or f"Collection {cid}"
+        nm = names.get(cid) or f"Collection {cid}"
         rows.append([InlineKeyboardButton(f"{nm} ({cid}) — {cnt}", callback_data=f"owned:set:{cid}")])
     nav = []
     if page > 0: nav.append(InlineKeyboardButton("⬅️ Prev", callback_data="owned:prev"))
@@ -594,7 +894,7 @@ async def render_owned_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text(title, reply_markup=kb)
     uid = update.effective_user.id
     u = user_state(uid); u["last_view"] = "owned"; u["owned"] = {"rows": rows, "page": page}
-    save_state()
+    schedule_save()
 
 def build_progress_keyboard(from_find: bool = False, from_owned: bool = False) -> InlineKeyboardMarkup:
     row1 = [
@@ -613,16 +913,16 @@ async def render_progress_page(update: Update, context: ContextTypes.DEFAULT_TYP
     s = context.user_data.get("progress") or {}
     cid = s.get("cid") or ""
     name = s.get("name") or (collections_get_name(cid) or cid)
-    all_ids: list[str] = s.get("ids") or []
-    have_set: set[str] = s.get("have") or set()
+    have_set: frozenset[str] = s.get("have") or frozenset()
     mode: str = s.get("mode") or "all"
     page = int(s.get("page") or 0)
 
-    total_all = len(all_ids)
-    have_count = sum(1 for t in all_ids if t in have_set)
+    views = progress_views(s)
+    total_all = len(views["all"])
+    have_count = len(views["owned"])
     overall_pct = round(100 * have_count / total_all, 2) if total_all else 0.0
 
-    ids = filter_ids(all_ids, have_set, mode)
+    ids = views[mode]
     total = len(ids)
     total_pages = max(1, (total + PROGRESS_PAGE_SIZE - 1) // PROGRESS_PAGE_SIZE)
 
@@ -643,11 +943,12 @@ async def render_progress_page(update: Update, context: ContextTypes.DEFAULT_TYP
 
     uid = update.effective_user.id
     u = user_state(uid); u["last_view"] = "progress"
-    prog_copy = {**s, "have": sorted(list(s.get("have", set())))}  # JSON-serializable
+    prog_copy = {k: v for k, v in s.items() if k not in ("_views", "_packed")}  # JSON-serializable
+    prog_copy["ids"], prog_copy["have"] = packed_progress(s)
     u["progress"] = prog_copy
     if s.get("cid"):
-        u["collection"] = s["cid"]; USER_COLLECTION[uid] = s["cid"]
-    save_state()
+        u["collection"] = s["cid"]
+    schedule_save()
 
 # ─────────────────────────────────────────────
 # Commands — collections & wallet + WebApp
@@ -665,7 +966,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Restore last view if present
     if last == "progress" and u.get("progress"):
-        p = dict(u["progress"]); p["have"] = set(p.get("have", []))
+        p = dict(u["progress"]); p["have"] = frozenset(unpack_token_ids(p.get("have")))
+        p["ids"] = unpack_token_ids(p.get("ids"))
         context.user_data["progress"] = p
         await render_progress_page(update, context, edit=False)
         if open_webapp:
@@ -703,42 +1005,38 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_reply(update, "Or launch the Web App:", open_webapp)
 
 async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = "query { RequestAccount { qrCode verificationId } }"
-    data = enjin_graphql(q)["RequestAccount"]
+    data = (await enjin_graphql_async(_Q_REQUEST_ACCOUNT))["RequestAccount"]
     await update.message.reply_photo(data["qrCode"], caption="Scan with your Enjin Wallet to link.")
-    poll_q = """
-    query GetAccountVerified($vid: String) {
-      GetAccountVerified(verificationId: $vid) { verified account { address } }
-    }
-    """
-    for _ in range(30):
-        d = enjin_graphql(poll_q, {"vid": data["verificationId"]})["GetAccountVerified"]
+    # Poll the small status query with backoff (awaited, so other users' updates keep flowing);
+    # fetch the address once, after it's verified.
+    vid = data["verificationId"]
+    delay, deadline = 1.0, time.monotonic() + CONNECT_POLL_WINDOW
+    while time.monotonic() < deadline:
+        d = (await enjin_graphql_async(_Q_VERIFY_STATUS, {"vid": vid}))["GetAccountVerified"]
         if d and d.get("verified"):
+            d = (await enjin_graphql_async(_Q_VERIFIED_ACCOUNT, {"vid": vid}))["GetAccountVerified"]
             addr = d["account"]["address"]
 
             uid = update.effective_user.id
-            USER_ADDRESS[uid] = addr
-            u = user_state(uid); u["address"] = addr; save_state()
+            u = user_state(uid); u["address"] = addr; schedule_save()
 
-            cache_user_wallet(uid, update.effective_user.username, addr)
-
-            def _push():
-                post_wallet_to_webapp(uid, update.effective_user.username, addr)
-            await asyncio.to_thread(_push)
+            await asyncio.to_thread(cache_user_wallet, uid, update.effective_user.username, addr)
+            # external save is best-effort: don't hold the reply for it
+            spawn_bg(post_wallet_to_webapp(uid, update.effective_user.username, addr), name=f"wallet-push-{uid}")
 
             await update.message.reply_text("✅ Wallet connected. Use 🔎 Find collection or /findcollection.")
             return
-        time.sleep(1)
+        await asyncio.sleep(delay)
+        delay = min(CONNECT_POLL_MAX_DELAY, delay * 1.5)
     await update.message.reply_text("Still waiting… run /connect again if needed.")
 
 async def disconnect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    USER_ADDRESS.pop(uid, None)
-    u = user_state(uid); u["address"] = None; save_state()
+    u = user_state(uid); u["address"] = None; schedule_save()
     await update.message.reply_text("🔌 Disconnected. I won't remember your wallet address anymore.")
 
 async def mywallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    addr = USER_ADDRESS.get(update.effective_user.id)
+    addr = get_user_address(update.effective_user.id)
     if not addr:
         await update.message.reply_text("No wallet linked. Use /connect."); return
     await update.message.reply_text(f"🔎 Address: {addr}\n🌐 Endpoint: {ENJIN_API}")
@@ -746,18 +1044,17 @@ async def mywallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def syncwallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     username = update.effective_user.username or str(uid)
-    wallet = get_cached_wallet(uid) or USER_ADDRESS.get(uid)
+    wallet = get_cached_wallet(uid) or get_user_address(uid)
     if not wallet:
         await update.message.reply_text("No wallet saved yet. Use /connect first.")
         return
-    cache_user_wallet(uid, username, wallet)
-    def _push(): post_wallet_to_webapp(uid, update.effective_user.username, wallet)
-    await asyncio.to_thread(_push)
+    await asyncio.to_thread(cache_user_wallet, uid, username, wallet)
+    spawn_bg(post_wallet_to_webapp(uid, update.effective_user.username, wallet), name=f"wallet-push-{uid}")
     await update.message.reply_text("✅ Wallet sync requested. Check your web app DB/logs.")
 
 async def mycollections(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    addr = USER_ADDRESS.get(uid)
+    addr = get_user_address(uid)
     if not addr:
         await update.message.reply_text("Use /connect first.")
         return
@@ -773,11 +1070,11 @@ async def mycollections(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         context.application.create_task(refresh_owned_cache(uid, addr))
 
-    unknown = [cid for cid in owned.keys() if collections_get_name(cid) is None]
+    known = collections_get_names(list(owned.keys()))
+    unknown = [cid for cid in owned.keys() if cid not in known]
     if unknown:
-        add_to_tracked(unknown)
-        for cid in unknown:
-            resolve_and_store_name(cid)
+        await asyncio.to_thread(add_to_tracked, unknown)
+        await resolve_and_store_names(unknown)
 
     counts = {cid: len(tset) for cid, tset in owned.items()}
     if not counts:
@@ -790,35 +1087,34 @@ async def mycollections(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def setcollection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if uid not in USER_ADDRESS:
+    if not get_user_address(uid):
         await update.message.reply_text("Use /connect first."); return
     if not context.args:
         await update.message.reply_text("Usage: /setcollection <collectionId>"); return
     cid = context.args[0].strip()
-    add_to_tracked([cid])
-    label = resolve_and_store_name(cid)
-    USER_COLLECTION[uid] = cid
-    u = user_state(uid); u["collection"] = cid; save_state()
+    await asyncio.to_thread(add_to_tracked, [cid])
+    label = await resolve_and_store_name(cid)
+    u = user_state(uid); u["collection"] = cid; schedule_save()
     await update.message.reply_text(f"📚 Collection set to {label} ({cid}). Now run /collections.")
 
 async def collections_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     username = update.effective_user.username or str(uid)
-    wallet = get_cached_wallet(uid) or USER_ADDRESS.get(uid)
+    wallet = get_cached_wallet(uid) or get_user_address(uid)
     if wallet:
-        cache_user_wallet(uid, username, wallet)
+        await asyncio.to_thread(cache_user_wallet, uid, username, wallet)
 
     addr = wallet
-    cid = USER_COLLECTION.get(uid)
+    cid = get_user_collection(uid)
     if not addr:
         await update.message.reply_text("Use /connect first."); return
     if not cid:
         await update.message.reply_text("Set a collection first with 🔎 Find collection or /setcollection."); return
 
-    add_to_tracked([cid])
-    label = resolve_and_store_name(cid)
+    await asyncio.to_thread(add_to_tracked, [cid])
+    label = await resolve_and_store_name(cid)
     try:
-        ids_sorted = get_collection_token_ids_cached(cid, max_age_sec=1800, force=False)
+        ids_sorted = await asyncio.to_thread(get_collection_token_ids_cached, cid, 1800)
     except Exception as e:
         await update.message.reply_text("Could not fetch collection.\n" + str(e)); return
     if not ids_sorted:
@@ -827,52 +1123,75 @@ async def collections_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     owned_cached = _owned_cache_get(uid)
     if owned_cached is None and addr:
         context.application.create_task(refresh_owned_cache(uid, addr))
-        have_set = set()
+        have_set = frozenset()
     else:
-        have_set = owned_cached.get(cid, set())
+        have_set = owned_cached.get(cid, frozenset())  # shared with OWNED_CACHE; frozen, so no copy needed
 
     context.user_data["progress"] = {
         "cid": cid, "name": label, "ids": ids_sorted,
-        "have": set(have_set), "page": 0, "mode": "all",
+        "have": have_set, "page": 0, "mode": "all",
     }
     await render_progress_page(update, context, edit=False)
 
 # ─────────────────────────────────────────────
 # Search command (DB first; fallback JSON)
-async def findcollection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def _search_total(term: str) -> int:
+    total = collections_search_count(term)
+    if not total:
+        entries = load_collections_json()
+        backup = [(e["id"], e["name"]) for e in entries if term.lower() in e.get("name","").lower()]
+        if backup:
+            collections_fill_missing(backup)  # restore backup rows so pages can be queried; fresher names win
+            total = collections_search_count(term)
+    return total
+
+async def _warm_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     username = update.effective_user.username or str(uid)
-    wallet = get_cached_wallet(uid) or USER_ADDRESS.get(uid)
+    wallet = get_cached_wallet(uid) or get_user_address(uid)
     if wallet:
-        cache_user_wallet(uid, username, wallet)
+        await asyncio.to_thread(cache_user_wallet, uid, username, wallet)
         context.application.create_task(refresh_owned_cache(uid, wallet))
 
+async def _find_and_show(update: Update, context: ContextTypes.DEFAULT_TYPE, term: str, target=None):
+    # `target`: an already-sent placeholder message to edit into the results
+    await _warm_wallet(update, context)
+    total = await asyncio.to_thread(_search_total, term)
+    if not total:
+        if target is not None:  # one message: the ack becomes the answer (the reply keyboard is still up)
+            await target.edit_text(f"No collections matched “{term}”. Try again or tap a button.")
+        else:
+            await show_main_keyboard(update, "No collections matched. Try again or tap a button.")
+        return
+    context.user_data["find"] = {"term": term, "page": 0, "total": total}
+    await render_find_page(update, context, edit=False, target=target)
+
+async def findcollection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
+        await _warm_wallet(update, context)
         context.user_data[AWAITING_FIND_FLAG] = True
         await update.message.reply_text("Type a name or part of a name to search:", reply_markup=ReplyKeyboardRemove())
         return
-    term = " ".join(context.args).strip()
-    matches = collections_search(term, limit=400)
-    if not matches:
-        entries = load_collections_json()
-        matches = [(e["id"], e["name"]) for e in entries if term.lower() in e.get("name","").lower()]
-    if not matches:
-        await show_main_keyboard(update, "No collections matched. Try again or tap a button."); return
-    context.user_data["find"] = {"term": term, "matches": matches, "page": 0}
-    await render_find_page(update, context, edit=False)
+    await _find_and_show(update, context, " ".join(context.args).strip())
 
 # Reply-keyboard taps
+async def _find_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data[AWAITING_FIND_FLAG] = True
+    await update.message.reply_text("Type a name or part of a name to search:", reply_markup=ReplyKeyboardRemove())
+
+# Keyword -> handler, checked in this order; taps on the keyboard's exact labels skip normalisation
+_REPLY_BUTTONS = {"connect wallet": connect, "find collection": _find_prompt, "my collections": mycollections}
+_REPLY_LABELS = {"🔗 Connect wallet": connect, "🔎 Find collection": _find_prompt, "📈 My collections": mycollections}
+_BTN_STRIP = str.maketrans("", "", string.punctuation)
+
 async def on_reply_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     raw = (update.message.text or "")
-    norm = "".join(ch for ch in raw if ch.isalnum() or ch.isspace()).lower()
-    if "connect wallet" in norm:
-        await connect(update, context); return
-    if "find collection" in norm:
-        context.user_data[AWAITING_FIND_FLAG] = True
-        await update.message.reply_text("Type a name or part of a name to search:", reply_markup=ReplyKeyboardRemove())
-        return
-    if "my collections" in norm:
-        await mycollections(update, context); return
+    handler = _REPLY_LABELS.get(raw)
+    if handler is None:
+        norm = raw.translate(_BTN_STRIP).lower()
+        handler = next((h for kw, h in _REPLY_BUTTONS.items() if kw in norm), None)
+    if handler:
+        await handler(update, context)
 
 # Capture search term after prompt
 async def capture_find_term(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -880,212 +1199,211 @@ async def capture_find_term(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     term = (update.message.text or "").strip()
     context.user_data[AWAITING_FIND_FLAG] = False
-    saved_args = getattr(context, "args", None)
-    context.args = [term]
-    try:
-        await findcollection(update, context)
-    finally:
-        context.args = saved_args
+    # Ack right away; the search runs in the background and edits this message into the results
+    ack = await update.message.reply_text(f"🔎 Searching for “{term}”…")
+    context.application.create_task(_find_and_show(update, context, term, target=ack))
+
+# Single entry for plain text: a pending search prompt wins over reply-keyboard matching
+async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get(AWAITING_FIND_FLAG):
+        await capture_find_term(update, context)
+    else:
+        await on_reply_button(update, context)
 
 # ─────────────────────────────────────────────
 # Callback handler routing (Collections UIs)
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    try: await q.answer()
-    except Exception: pass
-    data = q.data or ""
-
-    # Find pager/close
-    if data.startswith("find:"):
-        s = context.user_data.get("find") or {}
-        page = int(s.get("page") or 0)
-        total = len(s.get("matches") or [])
-        if data == "find:prev" and page > 0:
-            s["page"] = page - 1; context.user_data["find"] = s
-            await render_find_page(update, context, edit=True); return
-        if data == "find:next" and (page + 1) * PAGE_SIZE < total:
-            s["page"] = page + 1; context.user_data["find"] = s
-            await render_find_page(update, context, edit=True); return
-        if data == "find:close":
-            context.user_data.pop("find", None)
-            u = user_state(q.from_user.id)
-            if u.get("last_view") == "find":
-                u["last_view"] = None; save_state()
-            await edit_or_send(update, "Search closed.")
-            await show_main_keyboard(update, "What would you like to do next?"); return
-        return
+# callback_data is "<head>:<rest>"; each head maps to a sub-router keyed on rest.
 
-    # Owned pager/select/close
-    if data.startswith("owned:"):
-        s = context.user_data.get("owned") or {}
-        page = int(s.get("page") or 0)
-        total = len(s.get("rows") or [])
+# Find pager/close
+async def _find_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    page = int(s.get("page") or 0)
+    if page > 0:
+        s["page"] = page - 1; context.user_data["find"] = s
+        await render_find_page(update, context, edit=True)
 
-        if data == "owned:prev" and page > 0:
-            s["page"] = page - 1
-            context.user_data["owned"] = s
-            await render_owned_page(update, context, edit=True)
-            return
+async def _find_next(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    page = int(s.get("page") or 0)
+    if s.get("has_more"):
+        s["page"] = page + 1; context.user_data["find"] = s
+        await render_find_page(update, context, edit=True)
+
+async def _find_close(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    context.user_data.pop("find", None)
+    u = user_state(update.callback_query.from_user.id)
+    if u.get("last_view") == "find":
+        u["last_view"] = None; schedule_save()
+    await edit_or_send(update, "Search closed.")
+    await show_main_keyboard(update, "What would you like to do next?")
+
+FIND_ROUTES = {"prev": _find_prev, "next": _find_next, "close": _find_close}
+
+async def _find_router(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str):
+    handler = FIND_ROUTES.get(rest)
+    if handler:
+        await handler(update, context, context.user_data.get("find") or {})
+
+# Owned pager/select/close
+async def _owned_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict, arg: str):
+    page = int(s.get("page") or 0)
+    if page > 0:
+        s["page"] = page - 1
+        context.user_data["owned"] = s
+        await render_owned_page(update, context, edit=True)
 
-        if data == "owned:next" and (page + 1) * OWNED_PAGE_SIZE < total:
-            s["page"] = page + 1
-            context.user_data["owned"] = s
-            await render_owned_page(update, context, edit=True)
-            return
+async def _owned_next(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict, arg: str):
+    page = int(s.get("page") or 0)
+    if (page + 1) * OWNED_PAGE_SIZE < len(s.get("rows") or []):
+        s["page"] = page + 1
+        context.user_data["owned"] = s
+        await render_owned_page(update, context, edit=True)
+
+async def _owned_close(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict, arg: str):
+    context.user_data.pop("owned", None)
+    u = user_state(update.callback_query.from_user.id)
+    if u.get("last_view") == "owned":
+        u["last_view"] = None
+        schedule_save()
+    await edit_or_send(update, "Owned list closed.")
+    await show_main_keyboard(update, "What would you like to do next?")
+
+# Shared by owned:set:<cid> and setcol:<cid>; `origin` ("from_owned"/"from_find") drives the Back button
+async def _enter_progress(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: str, origin: str):
+    q = update.callback_query
+    await asyncio.to_thread(add_to_tracked, [cid])
+    # Render with the cached label now; resolve the real name in the background for next time.
+    label = collections_get_name(cid) or f"Collection {cid}"
+    context.application.create_task(resolve_and_store_name(cid))
 
-        if data == "owned:close":
-            context.user_data.pop("owned", None)
-            u = user_state(q.from_user.id)
-            if u.get("last_view") == "owned":
-                u["last_view"] = None
-                save_state()
-            await edit_or_send(update, "Owned list closed.")
-            await show_main_keyboard(update, "What would you like to do next?")
-            return
+    u = user_state(q.from_user.id)
+    u["collection"] = cid
+    schedule_save()
 
-        if data.startswith("owned:set:"):
-            cid = data.split(":", 2)[2]
-            add_to_tracked([cid])
-            label = resolve_and_store_name(cid)
+    addr = get_user_address(q.from_user.id)
+    if not addr:
+        await edit_or_send(update, f"📚 Collection set to {label} ({cid}). Now /connect to link a wallet.")
+        await show_main_keyboard(update, "Link a wallet to view progress.")
+        return
 
-            USER_COLLECTION[q.from_user.id] = cid
-            u = user_state(q.from_user.id)
-            u["collection"] = cid
-            save_state()
+    try:
+        ids_sorted = await asyncio.to_thread(get_collection_token_ids_cached, cid, 1800)
+    except Exception as e:
+        await edit_or_send(update, "Could not fetch collection.\n" + str(e))
+        return
 
-            addr = USER_ADDRESS.get(q.from_user.id)
-            if not addr:
-                await edit_or_send(update, f"📚 Collection set to {label} ({cid}). Now /connect to link a wallet.")
-                await show_main_keyboard(update, "Link a wallet to view progress.")
-                return
+    if not ids_sorted:
+        await edit_or_send(update, "No tokens found in that collection.")
+        return
 
-            try:
-                ids_sorted = get_collection_token_ids_cached(cid, max_age_sec=1800, force=False)
-            except Exception as e:
-                await edit_or_send(update, "Could not fetch collection.\n" + str(e))
-                return
+    owned_cached = _owned_cache_get(q.from_user.id)
+    if owned_cached is None:
+        context.application.create_task(refresh_owned_cache(q.from_user.id, addr))
+        have_set = frozenset()
+    else:
+        have_set = owned_cached.get(cid, frozenset())
 
-            if not ids_sorted:
-                await edit_or_send(update, "No tokens found in that collection.")
-                return
+    context.user_data["progress"] = {
+        "cid": cid,
+        "name": label,
+        "ids": ids_sorted,
+        "have": have_set,
+        "page": 0,
+        "mode": "all",
+        origin: True,
+    }
+    await render_progress_page(update, context, edit=True)
 
-            owned_cached = _owned_cache_get(q.from_user.id)
-            if owned_cached is None:
-                context.application.create_task(refresh_owned_cache(q.from_user.id, addr))
-                have_set = set()
-            else:
-                have_set = owned_cached.get(cid, set())
-
-            context.user_data["progress"] = {
-                "cid": cid,
-                "name": label,
-                "ids": ids_sorted,
-                "have": set(have_set),
-                "page": 0,
-                "mode": "all",
-                "from_owned": True,
-            }
-            await render_progress_page(update, context, edit=True)
-            return
+async def _owned_set(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict, cid: str):
+    await _enter_progress(update, context, cid, "from_owned")
 
-    # Progress pager/toggle/refresh/back/close
-    if data.startswith("prog:"):
-        s = context.user_data.get("progress") or {}
-        page = int(s.get("page") or 0)
-        mode = s.get("mode") or "all"
-        cid  = s.get("cid")
-        ids  = s.get("ids") or []
-        have = s.get("have") or set()
-        filtered_total = len(filter_ids(ids, have, mode))
-
-        if data == "prog:prev" and page > 0:
-            s["page"] = page - 1; context.user_data["progress"] = s
-            await render_progress_page(update, context, edit=True); return
-        if data == "prog:next" and (page + 1) * PROGRESS_PAGE_SIZE < filtered_total:
-            s["page"] = page + 1; context.user_data["progress"] = s
-            await render_progress_page(update, context, edit=True); return
-        if data == "prog:toggle":
-            s["mode"] = next_mode(mode); s["page"] = 0
-            context.user_data["progress"] = s
-            await render_progress_page(update, context, edit=True); return
-        if data == "prog:refresh":
-            if cid:
-                add_to_tracked([cid])
-                s["name"] = resolve_and_store_name(cid)
-                try:
-                    ids_sorted = get_collection_token_ids_cached(cid, max_age_sec=0, force=True)
-                    s["ids"] = ids_sorted
-                    addr = USER_ADDRESS.get(q.from_user.id)
-                    have_set = get_wallet_owned_by_collection(addr).get(cid, set()) if addr else set()
-                    s["have"] = set(have_set); s["page"] = 0
-                    context.user_data["progress"] = s
-                except Exception:
-                    pass
-            await render_progress_page(update, context, edit=True); return
-        if data == "prog:back":
-            find_state = context.user_data.get("find") or user_state(q.from_user.id).get("find")
-            if find_state:
-                context.user_data["find"] = find_state; await render_find_page(update, context, edit=True)
-            return
-        if data == "prog:back_owned":
-            owned_state = context.user_data.get("owned") or user_state(q.from_user.id).get("owned")
-            if owned_state:
-                context.user_data["owned"] = owned_state; await render_owned_page(update, context, edit=True)
-            return
-        if data == "prog:close":
-            context.user_data.pop("progress", None)
-            u = user_state(q.from_user.id)
-            if u.get("last_view") == "progress":
-                u["last_view"] = None; save_state()
-            await edit_or_send(update, "Progress closed.")
-            await show_main_keyboard(update, "What would you like to do next?"); return
-        return
+OWNED_ROUTES = {"prev": _owned_prev, "next": _owned_next, "close": _owned_close, "set": _owned_set}
 
-    # Select from Find → jump straight into progress
-    if data.startswith("setcol:"):
-        cid = data.split(":", 1)[1]
-        add_to_tracked([cid])
-        label = resolve_and_store_name(cid)
-
-        USER_COLLECTION[q.from_user.id] = cid
-        u = user_state(q.from_user.id)
-        u["collection"] = cid
-        save_state()
-
-        addr = USER_ADDRESS.get(q.from_user.id)
-        if not addr:
-            await edit_or_send(update, f"📚 Collection set to {label} ({cid}). Now /connect to link a wallet.")
-            await show_main_keyboard(update, "Link a wallet to view progress.")
-            return
+async def _owned_router(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str):
+    sub, _, arg = rest.partition(":")
+    handler = OWNED_ROUTES.get(sub)
+    if handler:
+        await handler(update, context, context.user_data.get("owned") or {}, arg)
 
-        try:
-            ids_sorted = get_collection_token_ids_cached(cid, max_age_sec=1800, force=False)
-        except Exception as e:
-            await edit_or_send(update, "Could not fetch collection.\n" + str(e))
-            return
+# Progress pager/toggle/refresh/back/close
+def _prog_filtered_total(s: dict) -> int:
+    return len(progress_views(s)[s.get("mode") or "all"])
 
-        if not ids_sorted:
-            await edit_or_send(update, "No tokens found in that collection.")
-            return
+async def _prog_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    page = int(s.get("page") or 0)
+    if page > 0:
+        s["page"] = page - 1; context.user_data["progress"] = s
+        await render_progress_page(update, context, edit=True)
 
-        owned_cached = _owned_cache_get(q.from_user.id)
-        if owned_cached is None:
-            context.application.create_task(refresh_owned_cache(q.from_user.id, addr))
-            have_set = set()
-        else:
-            have_set = owned_cached.get(cid, set())
-
-        context.user_data["progress"] = {
-            "cid": cid,
-            "name": label,
-            "ids": ids_sorted,
-            "have": set(have_set),
-            "page": 0,
-            "mode": "all",
-            "from_find": True,
-        }
+async def _prog_next(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    page = int(s.get("page") or 0)
+    if (page + 1) * PROGRESS_PAGE_SIZE < _prog_filtered_total(s):
+        s["page"] = page + 1; context.user_data["progress"] = s
         await render_progress_page(update, context, edit=True)
-        return
+
+async def _prog_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    s["mode"] = next_mode(s.get("mode") or "all"); s["page"] = 0
+    context.user_data["progress"] = s
+    await render_progress_page(update, context, edit=True)
+
+async def _prog_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    q = update.callback_query
+    cid = s.get("cid")
+    if cid:
+        await asyncio.to_thread(add_to_tracked, [cid])
+        s["name"] = await resolve_and_store_name(cid)
+        try:
+            ids_sorted = await asyncio.to_thread(get_collection_token_ids_cached, cid, 0, True)
+            s["ids"] = ids_sorted
+            addr = get_user_address(q.from_user.id)
+            owned = await asyncio.to_thread(get_wallet_owned_by_collection, addr) if addr else {}
+            have_set = owned.get(cid, frozenset())
+            s["have"] = have_set; s["page"] = 0
+            context.user_data["progress"] = s
+        except Exception:
+            pass
+    await render_progress_page(update, context, edit=True)
+
+async def _prog_back(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    find_state = context.user_data.get("find") or user_state(update.callback_query.from_user.id).get("find")
+    if find_state:
+        context.user_data["find"] = find_state; await render_find_page(update, context, edit=True)
+
+async def _prog_back_owned(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    owned_state = context.user_data.get("owned") or user_state(update.callback_query.from_user.id).get("owned")
+    if owned_state:
+        context.user_data["owned"] = owned_state; await render_owned_page(update, context, edit=True)
+
+async def _prog_close(update: Update, context: ContextTypes.DEFAULT_TYPE, s: dict):
+    context.user_data.pop("progress", None)
+    u = user_state(update.callback_query.from_user.id)
+    if u.get("last_view") == "progress":
+        u["last_view"] = None; schedule_save()
+    await edit_or_send(update, "Progress closed.")
+    await show_main_keyboard(update, "What would you like to do next?")
+
+PROG_ROUTES = {
+    "prev": _prog_prev, "next": _prog_next, "toggle": _prog_toggle, "refresh": _prog_refresh,
+    "back": _prog_back, "back_owned": _prog_back_owned, "close": _prog_close,
+}
+
+async def _prog_router(update: Update, context: ContextTypes.DEFAULT_TYPE, rest: str):
+    handler = PROG_ROUTES.get(rest)
+    if handler:
+        await handler(update, context, context.user_data.get("progress") or {})
+
+# Select from Find → jump straight into progress
+async def _setcol(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: str):
+    await _enter_progress(update, context, cid, "from_find")
+
+ROUTES = {"find": _find_router, "owned": _owned_router, "prog": _prog_router, "setcol": _setcol}
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    try: await q.answer()
+    except Exception: pass
+    head, _, rest = (q.data or "").partition(":")
+    handler = ROUTES.get(head)
+    if handler:
+        await handler(update, context, rest)
 
 # ─────────────────────────────────────────────
 # WebApp data handler (optional)
@@ -1100,61 +1418,66 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 # ─────────────────────────────────────────────
 # Hourly: refresh collections
-def get_all_collection_ids_from_api() -> list[str]:
-    q = """
-    query GetCollections($after: String, $first: Int = 200) {
-      GetCollections(after: $after, first: $first) {
-        edges { node { collectionId attributes { key value } } }
-        pageInfo { hasNextPage endCursor }
-      }
-    }
-    """
-    ids, after = [], None
-    while True:
-        data = enjin_graphql(q, {"after": after})["GetCollections"]
-        for e in data["edges"]:
-            ids.append(str(e["node"]["collectionId"]))
-        if not data["pageInfo"]["hasNextPage"]:
-            break
-        after = data["pageInfo"]["endCursor"]
+async def get_all_collection_ids_from_api() -> list[str]:
+    # Cursor pages are sequential by nature; request the next page as soon as its cursor is known
+    # so the network wait overlaps with unpacking the current page (same pattern as _fetch_owned_map).
+    async def _one_page(after):
+        return (await enjin_graphql_async(_Q_GET_COLLECTIONS, {"after": after}))["GetCollections"]
+
+    ids = []
+    pending = asyncio.ensure_future(_one_page(None))
+    try:
+        while pending:
+            data = await pending
+            pending = None
+            if data["pageInfo"]["hasNextPage"]:
+                pending = asyncio.ensure_future(_one_page(data["pageInfo"]["endCursor"]))
+                await asyncio.sleep(0)
+            ids.extend(str(e["node"]["collectionId"]) for e in data["edges"])
+    finally:
+        if pending:
+            pending.cancel()
     return ids
 
+def _collect_unnamed(ids: list[str]) -> list[str]:
+    todo = collections_bulk_insert_ids(ids, pick_unnamed=200)
+    add_to_tracked(ids[:200])  # small batch
+    return todo
+
+def _store_refreshed(rows: list[tuple[str, str]]):
+    collections_upsert(rows)
+    sync_json_from_db_if_needed()
+
 async def hourly_collections_refresh(context: ContextTypes.DEFAULT_TYPE):
+    # Paging and name lookups are awaited on the loop; blocking DB work runs in worker threads.
     try:
-        ids = get_all_collection_ids_from_api()
+        ids = await get_all_collection_ids_from_api()
         if not ids: return
-        collections_bulk_insert_ids(ids)
-        add_to_tracked(ids[:200])  # small batch
-        conn = get_conn(COLLECTION_DB); cur = conn.cursor()
-        cur.execute("""
-            SELECT id FROM collections
-            WHERE name LIKE 'Collection %'
-            ORDER BY updated_at ASC
-            LIMIT 200
-        """)
-        todo = [r[0] for r in cur.fetchall()]
-        conn.close()
-        rows = []
-        for cid in todo:
-            nm = resolve_name_via_attributes_or_uri(cid) or f"Collection {cid}"
-            rows.append((cid, nm))
-        collections_upsert(rows)
-        sync_json_from_db_if_needed()
-        print(f"✅ Collections refreshed: {len(ids)} ids (resolved {len(rows)} names).")
-    except Exception as e:
-        print(f"⚠️ Error refreshing collections: {e}")
+        todo = await asyncio.to_thread(_collect_unnamed, ids)
+        resolved = await resolve_names_async(todo)
+        rows = [(cid, nm or f"Collection {cid}") for cid, nm in zip(todo, resolved)]
+        await asyncio.to_thread(_store_refreshed, rows)
+        log.info("✅ Collections refreshed: %d ids (resolved %d names).", len(ids), len(rows))
+    except Exception:
+        log.exception("⚠️ Error refreshing collections")
 
 # ─────────────────────────────────────────────
 # Dispatcher
 def build_application() -> Application:
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Outbound Bot API calls: one HTTP/2 connection multiplexes concurrent sends (httpx[http2]); pool sized
+    # explicitly since older PTB releases default to a single connection. Webhook mode, so no getUpdates tuning.
+    app = (Application.builder().token(TELEGRAM_TOKEN)
+           .http_version("2").connection_pool_size(256).pool_timeout(1.0)
+           .build())
 
     # Commands
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("connect", connect))
+    # block=False: these await slow remote work (verification polling up to CONNECT_POLL_WINDOW, wallet paging),
+    # so PTB runs them as their own task and the update worker moves on to the next update.
+    app.add_handler(CommandHandler("connect", connect, block=False))
     app.add_handler(CommandHandler("disconnect", disconnect))
     app.add_handler(CommandHandler("mywallet", mywallet))
-    app.add_handler(CommandHandler("mycollections", mycollections))
+    app.add_handler(CommandHandler("mycollections", mycollections, block=False))
     app.add_handler(CommandHandler("setcollection", setcollection))
     app.add_handler(CommandHandler("collections", collections_cmd))
     app.add_handler(CommandHandler("findcollection", findcollection))
@@ -1164,8 +1487,7 @@ def build_application() -> Application:
     app.add_handler(CallbackQueryHandler(button_handler))
 
     # Text taps & capture search term
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, capture_find_term), group=0)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_reply_button), group=1)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
 
     # WebApp data
     app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
@@ -1174,13 +1496,23 @@ def build_application() -> Application:
     try:
         app.job_queue.run_repeating(hourly_collections_refresh, interval=3600, first=10)
     except Exception:
-        print("ℹ️ JobQueue not available. Skipping hourly refresh.")
+        log.info("ℹ️ JobQueue not available. Skipping hourly refresh.")
 
     return app
 
 # ─────────────────────────────────────────────
 # FastAPI app (bot + dice API + static)
-fastapi_app = FastAPI(title="Telegram Bot + Dice API")
+API_JSONResponse = ORJSONResponse if HAVE_ORJSON else JSONResponse
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    await _on_startup()
+    yield
+    await _on_shutdown()
+
+# Docs/OpenAPI endpoints are off: nothing uses them, and it saves building the schema.
+fastapi_app = FastAPI(title="Telegram Bot + Dice API", default_response_class=API_JSONResponse, lifespan=_lifespan,
+                      docs_url=None, redoc_url=None, openapi_url=None, swagger_ui_oauth2_redirect_url=None)
 
 # CORS
 FRONTEND_ORIGINS = os.getenv("FRONTEND_ORIGINS", "*")
@@ -1192,6 +1524,42 @@ fastapi_app.add_middleware(
     allow_methods=["GET", "POST", "OPTIONS"],
     allow_headers=["*"],
 )
+# Compress only bodies ≥1 KiB (web pages, leaderboards); the webhook ack and small JSON pass through untouched.
+# Level 1: most of the size win for the least CPU. /static is only PNG dice/backgrounds — already compressed,
+# so gzipping them burns CPU for nothing; those requests bypass the gzip layer.
+GZIP_SKIP_PREFIXES = ("/static/",)
+
+class SelectiveGZipMiddleware:
+    def __init__(self, app, minimum_size: int, compresslevel: int):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(GZIP_SKIP_PREFIXES):
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+fastapi_app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, compresslevel=1)
+
+MAX_BODY = 2 * 1024 * 1024  # no endpoint here legitimately receives more
+
+class BodySizeLimitMiddleware:
+    # Plain ASGI (added last → outermost): rejects an oversized declared Content-Length before routing or reading.
+    def __init__(self, app, max_bytes: int):
+        self.app, self.max_bytes = app, max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for k, v in scope["headers"]:
+                if k == b"content-length":
+                    if v.isdigit() and int(v) > self.max_bytes:
+                        await API_JSONResponse(status_code=413, content={"detail": "Payload too large"})(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+fastapi_app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_BODY)
 
 # Static mounts (serve from New/ since web/ and static/ live here)
 _FILE_DIR = pathlib.Path(__file__).resolve().parent     # .../New
@@ -1229,10 +1597,8 @@ _DB_PATH = pathlib.Path(os.getenv("DATABASE_PATH", _FILE_DIR / "storage" / "dice
 
 def _init_db():
     _DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with sqlite3.connect(_DB_PATH, timeout=10) as conn:
-        conn.execute("PRAGMA busy_timeout=5000;")
+    with _db() as conn:
         conn.executescript("""
-        PRAGMA journal_mode=WAL;
         CREATE TABLE IF NOT EXISTS users (
           telegram_id INTEGER PRIMARY KEY,
           username TEXT,
@@ -1271,15 +1637,20 @@ def _init_db():
           days_played INTEGER NOT NULL DEFAULT 0,
           PRIMARY KEY (telegram_id, week_id)
         );
-        CREATE INDEX IF NOT EXISTS idx_rolls_user_day  ON rolls(telegram_id, date_utc);
+        DROP INDEX IF EXISTS idx_rolls_user_day;
+        CREATE INDEX IF NOT EXISTS idx_rolls_user_day_time ON rolls(telegram_id, date_utc, created_at);
         CREATE INDEX IF NOT EXISTS idx_rolls_user_time ON rolls(created_at);
-        CREATE INDEX IF NOT EXISTS idx_daily_date_score ON daily_totals(date_utc, total_score DESC);
-        CREATE INDEX IF NOT EXISTS idx_week_week_score  ON weekly_totals(week_id, total_score DESC);
+        CREATE INDEX IF NOT EXISTS idx_rolls_user_created ON rolls(telegram_id, created_at);  -- last roll, any day
+        -- leaderboard indexes carry telegram_id so top-K and the rank probe are index-only scans
+        DROP INDEX IF EXISTS idx_daily_date_score;
+        DROP INDEX IF EXISTS idx_week_week_score;
+        CREATE INDEX IF NOT EXISTS idx_daily_date_score_user ON daily_totals(date_utc, total_score DESC, telegram_id);
+        CREATE INDEX IF NOT EXISTS idx_week_week_score_user  ON weekly_totals(week_id, total_score DESC, telegram_id);
         CREATE TABLE IF NOT EXISTS roll_requests (
           id INTEGER PRIMARY KEY AUTOINCREMENT,
           telegram_id INTEGER NOT NULL,
           key TEXT NOT NULL,
-          response_json TEXT NOT NULL,
+          response_json BLOB NOT NULL,  -- json_dumps bytes
           created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
           UNIQUE(telegram_id, key)
         );
@@ -1287,66 +1658,107 @@ def _init_db():
         """)
         conn.commit()
 
-def _db():
-    _DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    return sqlite3.connect(_DB_PATH, timeout=10)
+def _db() -> sqlite3.Connection:
+    # Same per-thread persistent connection as collection.db/app.db (WAL + PRAGMAs applied once,
+    # compiled statements stay in the connection's statement cache). `with _db()` commits/rolls back only.
+    return get_conn(_DB_PATH)
 
 _init_db()
 
-def _today_utc_str() -> str:
-    return datetime.now(timezone.utc).date().isoformat()
+# Dice faces pre-drawn from os.urandom in batches; bytes >= 252 are dropped so all six faces stay equally likely
+_DIE_BUF: deque[int] = deque()
 
-def _week_id(dt: Optional[date] = None) -> str:
-    d = dt or datetime.now(timezone.utc).date()
+def _roll_d6() -> int:
+    # popleft/extend are atomic, so roll worker threads can share the buffer
+    while True:
+        try:
+            return _DIE_BUF.popleft()
+        except IndexError:
+            _DIE_BUF.extend(1 + b % 6 for b in os.urandom(4096) if b < 252)
+
+# (next UTC midnight as epoch, "YYYY-MM-DD", "YYYY-Www"): date strings are rebuilt once per day, not per request
+_DAY_CACHE: tuple[float, str, str] = (0.0, "", "")
+
+def _utc_day() -> tuple[float, str, str]:
+    global _DAY_CACHE
+    now = time.time()
+    if now >= _DAY_CACHE[0]:
+        d = datetime.fromtimestamp(now, timezone.utc).date()
+        _DAY_CACHE = ((now // 86400 + 1) * 86400, d.isoformat(), _format_week(d))
+    return _DAY_CACHE
+
+def _format_week(d: date) -> str:
     y, wk, _ = d.isocalendar()
     return f"{y}-W{wk:02d}"
 
-def _rolls_used_today(user_id: int) -> int:
-    with _db() as conn:
-        cur = conn.execute("SELECT COUNT(*) FROM rolls WHERE telegram_id=? AND date_utc=?", (user_id, _today_utc_str()))
-        return int(cur.fetchone()[0])
+def _today_utc_str() -> str:
+    return _utc_day()[1]
 
-def _seconds_since_last_roll(user_id: int) -> float:
-    with _db() as conn:
-        cur = conn.execute(
-            "SELECT strftime('%s','now') - strftime('%s', MAX(created_at)) FROM rolls WHERE telegram_id=?",
-            (user_id,)
-        )
-        val = cur.fetchone()[0]
-        try:
-            return float(val if val is not None else 10_000.0)
-        except Exception:
-            return 10_000.0
+def _week_id(dt: Optional[date] = None) -> str:
+    return _format_week(dt) if dt else _utc_day()[2]
 
-def _upsert_daily_weekly(user_id: int, add_total: int):
-    tday = _today_utc_str()
-    wk = _week_id()
+def _rolls_used_today(user_id: int) -> int:
+    # daily_totals.rolls_count is bumped in the same transaction as every roll insert: one PK lookup
     with _db() as conn:
-        conn.execute("""
-            INSERT INTO daily_totals(telegram_id, date_utc, total_score, rolls_count)
-            VALUES(?,?,?,1)
-            ON CONFLICT(telegram_id, date_utc) DO UPDATE SET
-              total_score = total_score + excluded.total_score,
-              rolls_count = rolls_count + 1
-        """, (user_id, tday, add_total))
-        conn.execute("""
-            INSERT INTO weekly_totals(telegram_id, week_id, total_score, days_played)
-            VALUES(?,?,?,0)
-            ON CONFLICT(telegram_id, week_id) DO UPDATE SET
-              total_score = total_score + excluded.total_score
-        """, (user_id, wk, add_total))
-        conn.commit()
+        row = conn.execute("SELECT rolls_count FROM daily_totals WHERE telegram_id=? AND date_utc=?",
+                           (user_id, _today_utc_str())).fetchone()
+        return int(row[0]) if row else 0
+
+# uid -> time.monotonic() of the last accepted roll; lets repeat taps inside the cooldown skip SQLite.
+# The DB check in _roll_state stays authoritative (cold start, other workers).
+# Written by _do_roll in to_thread workers (under the lock), read lock-free on the loop (a single dict.get).
+LAST_ROLL_AT: dict[int, float] = {}
+_LAST_ROLL_LOCK = threading.Lock()
+_last_roll_day = ""
+
+def _note_roll(user_id: int, tday: str):
+    global _last_roll_day
+    now = time.monotonic()
+    with _LAST_ROLL_LOCK:
+        if tday != _last_roll_day:  # new UTC day: drop users whose cooldown has expired so the map doesn't grow forever
+            _last_roll_day = tday
+            for k in [k for k, t in LAST_ROLL_AT.items() if now - t >= COOLDOWN_S]:
+                del LAST_ROLL_AT[k]
+        LAST_ROLL_AT[user_id] = now
+
+def _cooldown_left(user_id: int) -> float:
+    last = LAST_ROLL_AT.get(user_id)
+    return 0.0 if last is None else COOLDOWN_S - (time.monotonic() - last)
+
+def _roll_state(conn: sqlite3.Connection, user_id: int, tday: str) -> tuple[int, float]:
+    # (rolls used today, seconds since the user's last roll on ANY day: the cooldown spans midnight)
+    used, since = conn.execute(
+        "SELECT (SELECT COUNT(*) FROM rolls WHERE telegram_id=?1 AND date_utc=?2), "
+        "strftime('%s','now') - strftime('%s', (SELECT MAX(created_at) FROM rolls WHERE telegram_id=?1))",
+        (user_id, tday)
+    ).fetchone()
+    return int(used), float(since if since is not None else 10_000.0)
+
+def _upsert_daily_weekly(conn: sqlite3.Connection, user_id: int, add_total: int, tday: str):
+    conn.execute("""
+        INSERT INTO daily_totals(telegram_id, date_utc, total_score, rolls_count)
+        VALUES(?,?,?,1)
+        ON CONFLICT(telegram_id, date_utc) DO UPDATE SET
+          total_score = total_score + excluded.total_score,
+          rolls_count = rolls_count + 1
+    """, (user_id, tday, add_total))
+    conn.execute("""
+        INSERT INTO weekly_totals(telegram_id, week_id, total_score, days_played)
+        VALUES(?,?,?,0)
+        ON CONFLICT(telegram_id, week_id) DO UPDATE SET
+          total_score = total_score + excluded.total_score
+    """, (user_id, _week_id(), add_total))
 
 def _json_error(status: int, code: str, **extra):
-    return JSONResponse(status_code=status, content={"error": code, **extra})
+    return API_JSONResponse(status_code=status, content={"error": code, **extra})
 
 def _get_idempo(conn: sqlite3.Connection, user_id: int, key: str):
     row = conn.execute("SELECT response_json FROM roll_requests WHERE telegram_id=? AND key=?", (user_id, key)).fetchone()
-    return json.loads(row[0]) if row else None
+    return json_loads(row[0]) if row else None  # older rows hold TEXT; both load the same
 
 def _save_idempo(conn: sqlite3.Connection, user_id: int, key: str, resp: dict):
     conn.execute("INSERT OR IGNORE INTO roll_requests(telegram_id, key, response_json) VALUES (?,?,?)",
-                 (user_id, key, json.dumps(resp, separators=(',', ':'))))
+                 (user_id, key, json_dumps(resp)))
 
 def _resolve_user_id(x_tg_id: Optional[str]) -> int:
     try:
@@ -1359,7 +1771,7 @@ def _resolve_user_id(x_tg_id: Optional[str]) -> int:
 @fastapi_app.get("/config")
 async def dice_config(x_tg_id: Optional[str] = Header(None)):
     uid = _resolve_user_id(x_tg_id)
-    used = _rolls_used_today(uid)
+    used = await asyncio.to_thread(_rolls_used_today, uid)
     return {
         "rolls_left": max(0, MAX_DAILY - used),
         "cooldown": COOLDOWN_S,
@@ -1372,33 +1784,37 @@ async def dice_roll(request: Request, x_tg_id: Optional[str] = Header(None)):
     uid = _resolve_user_id(x_tg_id)
     idem_key = request.headers.get("X-Idempotency-Key")
 
-    if idem_key:
-        with _db() as conn:
+    left = _cooldown_left(uid)
+    if left > 0 and not idem_key:  # keyed retries must still reach the idempotency replay below
+        return _json_error(429, "COOLDOWN_ACTIVE", seconds_remaining=round(left, 1))
+    # SQLite work (incl. the WAL commit) runs in a worker thread so the loop keeps serving other requests
+    return await asyncio.to_thread(_do_roll, uid, idem_key)
+
+def _do_roll(uid: int, idem_key: Optional[str]):
+    tday = _today_utc_str()
+    # One write transaction per roll: checks, insert, totals and idempotency record commit together
+    with _db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if idem_key:
             prev = _get_idempo(conn, uid, idem_key)
             if prev:
                 return prev
 
-    since = _seconds_since_last_roll(uid)
-    if since < COOLDOWN_S:
-        return _json_error(429, "COOLDOWN_ACTIVE", seconds_remaining=round(COOLDOWN_S - since, 1))
-
-    used = _rolls_used_today(uid)
-    if used >= MAX_DAILY:
-        return _json_error(400, "DAILY_LIMIT_REACHED", daily_limit=MAX_DAILY)
+        used, since = _roll_state(conn, uid, tday)
+        if since < COOLDOWN_S:
+            return _json_error(429, "COOLDOWN_ACTIVE", seconds_remaining=round(COOLDOWN_S - since, 1))
+        if used >= MAX_DAILY:
+            return _json_error(400, "DAILY_LIMIT_REACHED", daily_limit=MAX_DAILY)
 
-    d1 = random.randint(1, 6); d2 = random.randint(1, 6)
-    total = d1 + d2
-    idx = used + 1
-    tday = _today_utc_str()
+        d1 = _roll_d6(); d2 = _roll_d6()
+        total = d1 + d2
+        idx = used + 1
 
-    with _db() as conn:
         conn.execute("""
             INSERT INTO rolls(telegram_id, date_utc, roll_index, d1, d2, total, created_at)
             VALUES(?,?,?,?,?,?,datetime('now'))
         """, (uid, tday, idx, d1, d2, total))
-        conn.commit()
-
-        _upsert_daily_weekly(uid, total)
+        _upsert_daily_weekly(conn, uid, total, tday)
 
         resp = {
             "d1": d1, "d2": d2, "total": total,
@@ -1407,44 +1823,58 @@ async def dice_roll(request: Request, x_tg_id: Optional[str] = Header(None)):
             "daily_limit": MAX_DAILY,
         }
         if idem_key:
-            _save_idempo(conn, uid, idem_key, resp); conn.commit()
+            _save_idempo(conn, uid, idem_key, resp)
 
+    _note_roll(uid, tday)
     return resp
 
+# Leaderboards are read in bursts and the top list looks the same for every viewer: keep each bounded
+# (period, limit) top-K for a few seconds (staleness is fine at this TTL) and probe the viewer's own rank
+# on the covering index, as dice.py does.
+LB_CACHE_TTL = 3.0
+LEADERBOARD_MAX_LIMIT = 100  # the endpoints reject larger limits (422), so cached top lists stay small
+_LB_CACHE: dict[tuple[str, str, int], tuple[float, list]] = {}  # (sql, period, limit) -> (ts, top)
+
+_LB_SQL = "SELECT telegram_id, total_score FROM {table} WHERE {period}=? ORDER BY total_score DESC, telegram_id ASC LIMIT ?"
+_LB_DAILY_SQL = _LB_SQL.format(table="daily_totals", period="date_utc")
+_LB_WEEKLY_SQL = _LB_SQL.format(table="weekly_totals", period="week_id")
+# Rank = 1 + rows ahead in the same (score DESC, id ASC) order as the top list, so ties agree with it
+_RANK_SQL = """
+    SELECT 1 + (SELECT COUNT(*) FROM {table}
+                WHERE {period}=?1 AND (total_score > me.total_score
+                                       OR (total_score = me.total_score AND telegram_id < me.telegram_id))),
+           total_score
+    FROM {table} me WHERE telegram_id=?2 AND {period}=?1
+"""
+_RANK_DAILY_SQL = _RANK_SQL.format(table="daily_totals", period="date_utc")
+_RANK_WEEKLY_SQL = _RANK_SQL.format(table="weekly_totals", period="week_id")
+
+def _leaderboard(sql: str, rank_sql: str, period: str, limit: int, viewer: int):
+    now = time.monotonic()
+    key = (sql, period, limit)
+    with _db() as conn:
+        ent = _LB_CACHE.get(key)
+        if ent is None or now - ent[0] >= LB_CACHE_TTL:
+            rows = conn.execute(sql, (period, limit)).fetchall()
+            if len(_LB_CACHE) > 32:  # stale days/weeks, odd limits
+                _LB_CACHE.clear()
+            ent = _LB_CACHE[key] = (now, [{"rank": i, "user": str(uid), "score": sc} for i, (uid, sc) in enumerate(rows, 1)])
+        me = conn.execute(rank_sql, (period, viewer)).fetchone()
+    your_rank, your_score = me if me else (None, 0)
+    return ent[1], your_rank, your_score
+
 @fastapi_app.get("/leaderboard/daily")
-async def dice_leaderboard_daily(limit: int = 20, x_tg_id: Optional[str] = Header(None)):
+async def dice_leaderboard_daily(limit: int = Query(20, ge=1, le=LEADERBOARD_MAX_LIMIT), x_tg_id: Optional[str] = Header(None)):
     tday = _today_utc_str()
     viewer = _resolve_user_id(x_tg_id)
-    with _db() as conn:
-        top = conn.execute("""
-            SELECT telegram_id, total_score FROM daily_totals
-            WHERE date_utc=? ORDER BY total_score DESC, telegram_id ASC LIMIT ?
-        """, (tday, limit)).fetchall()
-        rows = conn.execute("""
-            SELECT telegram_id, total_score FROM daily_totals
-            WHERE date_utc=? ORDER BY total_score DESC, telegram_id ASC
-        """, (tday,)).fetchall()
-    leaderboard = [{"rank": i+1, "user": str(uid), "score": sc} for i,(uid,sc) in enumerate(top)]
-    your_rank = next((i+1 for i,(uid,_) in enumerate(rows) if uid==viewer), None)
-    your_score = next((sc for uid,sc in rows if uid==viewer), 0)
+    leaderboard, your_rank, your_score = await asyncio.to_thread(_leaderboard, _LB_DAILY_SQL, _RANK_DAILY_SQL, tday, limit, viewer)
     return {"date": tday, "leaderboard": leaderboard, "your_rank": your_rank, "your_score": your_score}
 
 @fastapi_app.get("/leaderboard/weekly")
-async def dice_leaderboard_weekly(limit: int = 20, x_tg_id: Optional[str] = Header(None)):
+async def dice_leaderboard_weekly(limit: int = Query(20, ge=1, le=LEADERBOARD_MAX_LIMIT), x_tg_id: Optional[str] = Header(None)):
     wk = _week_id()
     viewer = _resolve_user_id(x_tg_id)
-    with _db() as conn:
-        top = conn.execute("""
-            SELECT telegram_id, total_score FROM weekly_totals
-            WHERE week_id=? ORDER BY total_score DESC, telegram_id ASC LIMIT ?
-        """, (wk, limit)).fetchall()
-        rows = conn.execute("""
-            SELECT telegram_id, total_score FROM weekly_totals
-            WHERE week_id=? ORDER BY total_score DESC, telegram_id ASC
-        """, (wk,)).fetchall()
-    leaderboard = [{"rank": i+1, "user": str(uid), "score": sc} for i,(uid,sc) in enumerate(top)]
-    your_rank = next((i+1 for i,(uid,_) in enumerate(rows) if uid==viewer), None)
-    your_score = next((sc for uid, sc in rows if uid == viewer), 0)
+    leaderboard, your_rank, your_score = await asyncio.to_thread(_leaderboard, _LB_WEEKLY_SQL, _RANK_WEEKLY_SQL, wk, limit, viewer)
     return {"week_id": wk, "leaderboard": leaderboard, "your_rank": your_rank, "your_score": your_score}
 
 # ─────────────────────────────────────────────
@@ -1467,7 +1897,8 @@ async def save_wallet(payload: WalletIn, _=Depends(require_api_key)):
     if not (w and len(w) >= 10):
         raise HTTPException(status_code=400, detail="wallet_address looks invalid")
     try:
-        cache_user_wallet(
+        await asyncio.to_thread(
+            cache_user_wallet,
             user_id=payload.telegram_id,
             username=(payload.username or "").strip(),
             wallet=w,
@@ -1479,7 +1910,7 @@ async def save_wallet(payload: WalletIn, _=Depends(require_api_key)):
 @fastapi_app.get("/api/wallets/{telegram_id}")
 async def get_wallet(telegram_id: int, _=Depends(require_api_key)):
     try:
-        w = get_cached_wallet(telegram_id)
+        w = await asyncio.to_thread(get_cached_wallet, telegram_id)
         return {"telegram_id": telegram_id, "wallet_address": w}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB error: {e}")
@@ -1488,44 +1919,163 @@ async def get_wallet(telegram_id: int, _=Depends(require_api_key)):
 # PTB Application & webhooks
 application = build_application()  # PTB Application instance
 
-@fastapi_app.on_event("startup")
+TG_MAX_CONN = int(os.getenv("TG_MAX_CONN", "100"))  # parallel webhook POSTs Telegram may open (API max 100, default 40)
+# Only what build_application() handles: commands/text/web_app_data arrive as "message", buttons as "callback_query".
+WEBHOOK_ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+WEBHOOK_FORCE_SET = os.getenv("WEBHOOK_FORCE_SET", "") == "1"
+
+async def _set_webhook_if_public():
+    if not PUBLIC_URL:
+        log.warning("⚠️ PUBLIC_URL not set; webhook will not be configured.")
+        return
+    url = f"{PUBLIC_URL}/webhook"
+    try:
+        # Redeploys usually keep the same registration; a getWebhookInfo read is cheaper than re-setting it.
+        # The secret isn't reported back, so set WEBHOOK_FORCE_SET=1 for the deploy that rotates it.
+        if not WEBHOOK_FORCE_SET:
+            info = await application.bot.get_webhook_info()
+            if (info.url == url and info.max_connections == TG_MAX_CONN
+                    and set(info.allowed_updates or ()) == set(WEBHOOK_ALLOWED_UPDATES)):
+                log.info("✅ Webhook already set to %s", url)
+                return
+        await application.bot.set_webhook(
+            url=url,
+            secret_token=(TELEGRAM_WEBHOOK_SECRET or None),
+            drop_pending_updates=True,
+            max_connections=TG_MAX_CONN,
+            allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+        )
+        log.info("✅ Webhook set to %s", url)
+    except Exception:
+        log.exception("⚠️ Failed to set webhook")
+
+_webhook_task: Optional[asyncio.Task] = None
+
 async def _on_startup():
+    global _webhook_task, _accepting_updates
     await application.initialize()
     await application.start()
-    if PUBLIC_URL:
-        try:
-            await application.bot.set_webhook(
-                url=f"{PUBLIC_URL}/webhook",
-                secret_token=(TELEGRAM_WEBHOOK_SECRET or None),
-                drop_pending_updates=True,
-            )
-            print(f"✅ Webhook set to {PUBLIC_URL}/webhook")
-        except Exception as e:
-            print(f"⚠️ Failed to set webhook: {e}")
-    else:
-        print("⚠️ PUBLIC_URL not set; webhook will not be configured.")
+    _start_update_workers()
+    _accepting_updates = True
+    # Registering the webhook is a Telegram round-trip; do it alongside serving instead of before it.
+    _webhook_task = asyncio.create_task(_set_webhook_if_public())
 
-@fastapi_app.on_event("shutdown")
 async def _on_shutdown():
+    global _accepting_updates
+    if _webhook_task and not _webhook_task.done():
+        _webhook_task.cancel()
+    # Order matters: stop taking updates, finish the ones Telegram already got a 200 for, then stop the bot.
+    # Every wait draws on one deadline, so the whole sequence fits inside gunicorn's graceful_timeout.
+    deadline = time.monotonic() + SHUTDOWN_BUDGET_S
+    left = lambda: max(0.0, deadline - time.monotonic())
+    _accepting_updates = False
+    try:
+        await asyncio.wait_for(asyncio.gather(*(q.join() for q in UPDATE_QUEUES)), left())
+    except asyncio.TimeoutError:
+        log.warning("⚠️ Shutdown: update drain timed out (%d still queued, %d in flight)",
+                    sum(q.qsize() for q in UPDATE_QUEUES), len(_CHAT_TAILS))
+    for t in UPDATE_WORKERS:
+        t.cancel()
     try:
-        await application.stop()
+        # stop() also waits on block=False handlers (e.g. /connect polling); past the deadline they're cancelled
+        await asyncio.wait_for(application.stop(), left())
         await application.shutdown()
     except Exception:
-        pass
+        log.warning("⚠️ Shutdown: bot did not stop cleanly within the budget")
+    save_state()  # flush any debounced write
+    if BG_TASKS:  # let in-flight wallet pushes finish with whatever budget is left
+        await asyncio.wait(set(BG_TASKS), timeout=left())
+    await ENJIN_HTTP.aclose()
+    await WEB_HTTP.aclose()
+    ENJIN_SESSION.close()
+
+_WEBHOOK_ACK = b'{"ok":true}'  # pre-serialized: the ack never changes
+WEBHOOK_MAX_BODY = 1 << 20  # 1 MiB; real Telegram updates are a few KB
+
+# Updates are sharded by chat_id over N bounded queues (same chat → same queue, so arrival order is kept).
+# Workers don't run handlers themselves: each update is handed off at once as a task chained behind its
+# chat's previous one, so a chat's updates stay in order while a slow chat never holds up the rest of its shard.
+UPDATE_WORKER_COUNT = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = 1000
+UPDATE_QUEUES: list[asyncio.Queue] = []
+SHUTDOWN_BUDGET_S = 25.0  # drain + bot stop + background pushes, together; gunicorn_conf.graceful_timeout exceeds it
+_accepting_updates = False  # True between startup and the start of shutdown
+UPDATE_WORKERS: list[asyncio.Task] = []
+
+UPDATE_MAX_INFLIGHT = int(os.getenv("UPDATE_MAX_INFLIGHT", "256"))
+_UPDATE_SLOTS = asyncio.Semaphore(UPDATE_MAX_INFLIGHT)  # backpressure: past this, workers stop dequeuing
+_CHAT_TAILS: dict[int, asyncio.Task] = {}  # chat_id -> task of that chat's latest update
+
+async def _process_after(prev: asyncio.Task | None, update: Update):
+    if prev is not None:
+        await asyncio.wait((prev,))  # ordering only; prev's outcome is its own
+    try:
+        await application.process_update(update)
+    except Exception:
+        log.exception("⚠️ Update processing failed")
+
+def _update_done(q: asyncio.Queue, chat_id: int, task: asyncio.Task):
+    _UPDATE_SLOTS.release()
+    q.task_done()  # counted at completion, so the shutdown drain also waits for in-flight handlers
+    if _CHAT_TAILS.get(chat_id) is task:
+        del _CHAT_TAILS[chat_id]
 
-@fastapi_app.post("/webhook")
+async def _update_worker(q: asyncio.Queue):
+    while True:
+        update = await q.get()
+        await _UPDATE_SLOTS.acquire()
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        task = _CHAT_TAILS[chat_id] = asyncio.create_task(_process_after(_CHAT_TAILS.get(chat_id), update))
+        task.add_done_callback(lambda t, q=q, c=chat_id: _update_done(q, c, t))
+
+def _start_update_workers():
+    for _ in range(UPDATE_WORKER_COUNT):
+        q = asyncio.Queue(maxsize=UPDATE_QUEUE_MAX)
+        UPDATE_QUEUES.append(q)
+        UPDATE_WORKERS.append(asyncio.create_task(_update_worker(q)))
+
+def _wanted_update(data: dict) -> bool:
+    # Mirrors build_application()'s handlers on the raw dict, so updates no handler would match (stickers, photos,
+    # member events, ...) are acked without building the typed Update tree via de_json.
+    if "callback_query" in data:
+        return True
+    msg = data.get("message")
+    return bool(msg) and ("text" in msg or "web_app_data" in msg)
+
+@fastapi_app.post("/webhook", response_model=None, include_in_schema=False)
 async def telegram_webhook(request: Request):
-    data = await request.json()
+    # Cheap checks first: spoofed or oversized POSTs are shed before anything is buffered or decoded.
+    if TELEGRAM_WEBHOOK_SECRET and request.headers.get("x-telegram-bot-api-secret-token") != TELEGRAM_WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="Invalid webhook secret")
+    if not _accepting_updates:  # starting up / draining for shutdown: Telegram retries non-2xx later
+        raise HTTPException(status_code=503, detail="Not accepting updates")
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > WEBHOOK_MAX_BODY:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    body = bytearray()
+    async for chunk in request.stream():  # also caps chunked bodies that declare no length
+        body += chunk
+        if len(body) > WEBHOOK_MAX_BODY:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    data = json_loads(bytes(body))
+    if not _wanted_update(data):
+        return Response(content=_WEBHOOK_ACK, media_type="application/json")
     update = Update.de_json(data, application.bot)
-    await application.process_update(update)
-    return {"ok": True}
+    # Hand off to the chat's worker queue and ack at once, so Telegram's connection isn't held for the handler chain.
+    chat_id = update.effective_chat.id if update.effective_chat else 0
+    await UPDATE_QUEUES[chat_id % len(UPDATE_QUEUES)].put(update)  # only waits when that queue is full
+    return Response(content=_WEBHOOK_ACK, media_type="application/json")
 
 # ─────────────────────────────────────────────
 # Local dev entrypoint
 if __name__ == "__main__":
     import uvicorn
     # IMPORTANT: module path must match your file location (New/main.py → "New.main")
-    uvicorn.run("New.main:fastapi_app", host="0.0.0.0", port=PORT, reload=False)
+    # uvicorn[standard]: loop/http "auto" pick uvloop + httptools when installed (no uvloop on Windows); the PTB app
+    # shares this loop. Single worker on purpose: bot state, caches and the webhook registration are per-process.
+    uvicorn.run("New.main:fastapi_app", host="0.0.0.0", port=PORT, reload=False,
+                loop="auto", http="auto", access_log=False)
 
 
 